@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import sys
+import json
+import argparse
+from typing import Any, Dict, Iterator, Tuple
+
+# metrics where higher values are better, all other values are timings
+HIGHER_IS_BETTER = ("PerSecond",)
+# counters which must not increase
+COUNTERS = ("Loaded",)
+
+
+def metrics(result: Dict[str, Any], prefix: str = "") -> Iterator[Tuple[str, float]]:
+    """Yield flattened metrics of benchmark result which are compared:
+    median timings, rates and counters"""
+    for key, value in result.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from metrics(value, name)
+        elif key == "median" or key.endswith(HIGHER_IS_BETTER + COUNTERS):
+            yield name, value
+
+
+def main() -> None:
+    """Compare two benchmark result files"""
+    parser = argparse.ArgumentParser(
+        description="Compare vircpt benchmark results, exit with error if "
+        "a metric regressed by more than the threshold"
+    )
+    parser.add_argument("baseline", type=str, help="Baseline result file")
+    parser.add_argument("current", type=str, help="Current result file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="Allowed regression in percent. (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for fileName in (args.baseline, args.current):
+        with open(fileName, "r", encoding="utf-8") as fh:
+            results.append(dict(metrics(json.load(fh)["benchmarks"])))
+
+    regressed = False
+    for name, old in sorted(results[0].items()):
+        new = results[1].get(name)
+        if new is None:
+            continue
+        if name.endswith(COUNTERS):
+            flag = "  REGRESSION" if new > old else ""
+            regressed = regressed or new > old
+            print(f"{name:50} {old:14} {new:14}{flag}")
+            continue
+        if not old:
+            continue
+        change = (new - old) / old * 100
+        if name.endswith(HIGHER_IS_BETTER):
+            change = -change
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{name:50} {old:14.6f} {new:14.6f} {change:+8.1f}%{flag}")
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
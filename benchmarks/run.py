@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from argparse import Namespace
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=import-outside-toplevel,wrong-import-position,protected-access
+from libvircpt.exceptions import NbdException
+
+log = logging.getLogger("benchmark")
+
+BENCHMARKS: Dict[str, Callable[[Namespace], Dict[str, Any]]] = {}
+
+
+class skipped(Exception):
+    """Benchmark requirements are not met"""
+
+
+def benchmark(func: Callable[[Namespace], Dict[str, Any]]):
+    """Register benchmark function"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Run func repeat times and return timings in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        "runs": repeat,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+    }
+
+
+def requireTools(*tools: str) -> None:
+    """Skip benchmark if tools are missing"""
+    missing = [tool for tool in tools if shutil.which(tool) is None]
+    if missing:
+        raise skipped(f"missing tools: {', '.join(missing)}")
+
+
+def domainXml(disks: int) -> str:
+    """Return domain XML with the given number of qcow2 disks"""
+    devices = "".join(
+        f"""
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/var/lib/libvirt/images/bench-{i}.qcow2'/>
+      <target dev='vd{chr(97 + i % 26)}{i // 26}' bus='virtio'/>
+    </disk>"""
+        for i in range(disks)
+    )
+    return f"""<domain type='test'>
+  <name>vircpt-bench</name>
+  <memory>1048576</memory>
+  <os><type>hvm</type></os>
+  <devices>{devices}
+  </devices>
+</domain>"""
+
+
+def connect(uri: str = "test:///default"):
+    """Connect libvirt test driver"""
+    try:
+        from libvircpt import client
+    except ImportError as e:
+        raise skipped(f"missing module: {e}") from e
+    return client.client(Namespace(uri=uri, user=None, password=None))
+
+
+def diskArgs() -> Namespace:
+    """Arguments used by getDomainDisks, as set by the command line parser"""
+    from libvircpt import options
+
+    parser = argparse.ArgumentParser()
+    options.addGeneralOptions(parser)
+    options.addCommands(parser)
+    return parser.parse_args(["-d", "bench", "create", "--name", "bench"])
+
+
+# modules which must not be loaded by commands not using them
+HEAVY_MODULES = ("asyncio", "libvirt", "lxml", "nbd", "rich", "zstandard")
+
+
+def importedModules(cmdLine: List[str]) -> List[str]:
+    """Return top level modules imported by command"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + cmdLine,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return sorted(modules)
+
+
+@benchmark
+def startup(args: Namespace) -> Dict[str, Any]:
+    """Wall time of interpreter start and CLI invocations which do not
+    connect libvirt, and heavy modules loaded by them: these must only
+    be imported by the subcommands using them"""
+    script = os.path.join(ROOT, "vircpt")
+
+    def _run(cmdLine: List[str]) -> Callable[[], None]:
+        return lambda: subprocess.run(cmdLine, capture_output=True, check=True)
+
+    helpCmd = [script, "--help"]
+    heavy = [mod for mod in importedModules(helpCmd) if mod in HEAVY_MODULES]
+    if heavy:
+        log.error("Startup regression: [%s] imported by --help", ",".join(heavy))
+    return {
+        "interpreter": measure(_run([sys.executable, "-c", "pass"]), args.repeat),
+        "help": measure(_run([sys.executable] + helpCmd), args.repeat),
+        "heavyModules": heavy,
+        "heavyModulesLoaded": len(heavy),
+    }
+
+
+@benchmark
+def xml(args: Namespace) -> Dict[str, Any]:
+    """Build checkpoint XML and parse domain XML for many disks"""
+    try:
+        from libvircpt import checkpoint
+    except ImportError as e:
+        raise skipped(f"missing module: {e}") from e
+    virtClient = connect()
+    vmConfig = domainXml(args.disks)
+    diskList = virtClient.getDomainDisks(diskArgs(), vmConfig)
+    repeat = args.repeat * 10
+    return {
+        "disks": len(diskList),
+        "createCheckpointXml": measure(
+            lambda: checkpoint._createCheckpointXml(diskList, "bench"),
+            repeat,
+        ),
+        "getDomainDisks": measure(
+            lambda: virtClient.getDomainDisks(diskArgs(), vmConfig), repeat
+        ),
+    }
+
+
+@benchmark
+def checkpointApi(args: Namespace) -> Dict[str, Any]:
+    """Create, list and delete checkpoints via libvirt test driver"""
+    try:
+        import libvirt
+        from libvircpt import checkpoint
+    except ImportError as e:
+        raise skipped(f"missing module: {e}") from e
+    virtClient = connect()
+    domObj = virtClient.getDomain("test")
+    names = [f"bench{i}" for i in range(args.repeat)]
+
+    def _create() -> None:
+        for name in names:
+            checkpoint.create(domObj, checkpoint._createCheckpointXml([], name))
+
+    def _delete() -> None:
+        for name in reversed(names):
+            checkpoint.delete(checkpoint.exists(domObj, name))
+
+    try:
+        result = {"checkpoints": len(names), "create": measure(_create, 1)}
+        result["info"] = measure(lambda: checkpoint.info(domObj), args.repeat)
+        result["delete"] = measure(_delete, 1)
+    except libvirt.libvirtError as e:
+        raise skipped(f"test driver: {e}") from e
+    return result
+
+
+class statsDomain:
+    """Domain stand-in returning increasing block statistics"""
+
+    def __init__(self) -> None:
+        self.operations = 0
+
+    def blockStatsFlags(self, _disk: str) -> Dict[str, int]:
+        """Return block statistics, 1ms latency per operation"""
+        self.operations += 100
+        return {
+            "rd_operations": self.operations,
+            "rd_total_times": self.operations * 1000000,
+        }
+
+
+@benchmark
+def adaptiveThrottle(args: Namespace) -> Dict[str, Any]:
+    """Start and stop the adaptive throttle, as done for each
+    nbdcopy --adaptive run"""
+    try:
+        from libvircpt import throttle, transfer
+    except ImportError as e:
+        raise skipped(f"missing module: {e}") from e
+
+    def _run() -> None:
+        limiter = transfer.rateLimiter(1024 * 1024 * 1024)
+        throttler = throttle.adaptiveThrottle(statsDomain(), ["sda"], limiter, 10.0)
+        throttler.start()
+        throttler.stop()
+        if throttler.is_alive():
+            raise RuntimeError("Throttle thread still running after stop")
+
+    return {"startStop": measure(_run, args.repeat)}
+
+
+def benchImage(tmpDir: str, size: int) -> str:
+    """Create qcow2 image with a persistent bitmap and every other
+    64 KiB block of the first half written after bitmap creation"""
+    requireTools("qemu-img", "qemu-io", "qemu-nbd")
+    image = os.path.join(tmpDir, "bench.qcow2")
+    subprocess.run(
+        ["qemu-img", "create", "-q", "-f", "qcow2", image, f"{size}"], check=True
+    )
+    subprocess.run(
+        ["qemu-img", "bitmap", "--add", "--enable", image, "bench"], check=True
+    )
+    writes: List[str] = []
+    for offset in range(0, size // 2, 128 * 1024):
+        writes += ["-c", f"write -P 0x55 {offset} 64k"]
+    subprocess.run(
+        ["qemu-io", "-f", "qcow2"] + writes + [image], capture_output=True, check=True
+    )
+    return image
+
+
+@benchmark
+def extentQuery(args: Namespace) -> Dict[str, Any]:
+    """Query rate of dirty bitmap and allocation extents"""
+    try:
+        from libvircpt import extents, nbdcli
+    except ImportError as e:
+        raise skipped(f"missing module: {e}") from e
+    result: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory(prefix="vircpt.bench.") as tmpDir:
+        image = benchImage(tmpDir, args.size * 1024 * 1024)
+        with nbdcli.serveImage(image, "qcow2", 1, "bench") as nbdUri:
+            for name, context in (
+                ("dirty", f"{extents.BITMAP_PREFIX}bench"),
+                ("allocation", extents.BASE_ALLOCATION),
+            ):
+                handle = nbdcli.connect(nbdUri, [context])
+                count = len(list(extents.query(handle, context)))
+                timing = measure(
+                    lambda h=handle, c=context: list(extents.query(h, c)),
+                    args.repeat,
+                )
+                nbdcli.disconnect(handle)
+                timing["extents"] = count
+                timing["extentsPerSecond"] = count / timing["median"]
+                result[name] = timing
+    return result
+
+
+def copyRanges(
+    args: Namespace, nbdUri: str, target: str, size: int, ranges: List[Any]
+) -> Dict[str, Any]:
+    """Measure copy of ranges into raw image"""
+    from libvircpt import transfer
+
+    opt = transfer.copyOptions(args.connections, args.requests)
+    stats: List[Any] = []
+
+    def _copy() -> None:
+        writer = transfer.fileWriter(target, size)
+        try:
+            stats.append(transfer.copy("bench", nbdUri, writer, ranges, opt))
+        finally:
+            writer.close()
+
+    timing = measure(_copy, args.repeat)
+    timing["bytes"] = stats[-1].bytes
+    timing["mibPerSecond"] = stats[-1].bytes / 1024 / 1024 / timing["median"]
+    return timing
+
+
+@benchmark
+def copyThroughput(args: Namespace) -> Dict[str, Any]:
+    """Copy throughput for full and dirty extents into raw image"""
+    try:
+        from libvircpt import extents, nbdcli
+    except ImportError as e:
+        raise skipped(f"missing module: {e}") from e
+    size = args.size * 1024 * 1024
+    result: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory(prefix="vircpt.bench.") as tmpDir:
+        image = benchImage(tmpDir, size)
+        target = os.path.join(tmpDir, "target.raw")
+        with nbdcli.serveImage(image, "qcow2", args.connections, "bench") as nbdUri:
+            handle = nbdcli.connect(nbdUri, [f"{extents.BITMAP_PREFIX}bench"])
+            dirty = extents.dirty(handle, "bench")
+            nbdcli.disconnect(handle)
+            for name, ranges in (("full", [(0, size)]), ("dirty", dirty)):
+                result[name] = copyRanges(args, nbdUri, target, size, ranges)
+    return result
+
+
+def run(args: Namespace) -> Dict[str, Any]:
+    """Run selected benchmarks"""
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    results: Dict[str, Any] = {}
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit(f"Unknown benchmark: [{name}]")
+        log.info("Running benchmark: [%s]", name)
+        try:
+            results[name] = BENCHMARKS[name](args)
+        except skipped as e:
+            log.warning("Skipping benchmark [%s]: %s", name, e)
+            results[name] = {"skipped": str(e)}
+        except (
+            NbdException,
+            OSError,
+            subprocess.CalledProcessError,
+            RuntimeError,
+        ) as e:
+            log.error("Benchmark [%s] failed: [%s]", name, e)
+            results[name] = {"error": str(e)}
+
+    return {
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "repeat": args.repeat,
+            "size": args.size,
+            "disks": args.disks,
+            "connections": args.connections,
+            "requests": args.requests,
+        },
+        "benchmarks": results,
+    }
+
+
+def main() -> None:
+    """Run benchmarks and write JSON results"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark vircpt hot paths using local stand-ins",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--only",
+        type=str,
+        default=None,
+        help=f"Comma separated list of benchmarks: {','.join(BENCHMARKS)}",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement")
+    parser.add_argument("--size", type=int, default=1024, help="Image size in MiB")
+    parser.add_argument("--disks", type=int, default=64, help="Disks in domain XML")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument(
+        "-o", "--output", type=str, default="-", help="Output file, - for stdout"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    result = run(args)
+    if args.output == "-":
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import contextvars
+import logging
+import argparse
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import libvirt
+import libvirtaio
+import nbd
+from libvircpt import backup
+from libvircpt import checkpoint
+from libvircpt import client
+from libvircpt import fs
+from libvircpt import options
+from libvircpt import registry
+from libvircpt import server
+from libvircpt import transfer
+from libvircpt.common import splitList
+from libvircpt.exceptions import (
+    BackupException,
+    CheckpointException,
+    DiskBackupFailed,
+    NbdConnectionError,
+    NbdException,
+)
+from libvircpt.logcount import currentDomain
+
+log = logging.getLogger("aio")
+
+_eventLoop = None
+
+
+def registerEventLoop() -> Any:
+    """Dispatch libvirt events and keepalive messages via the running
+    asyncio loop. Must be called before the libvirt connection is opened.
+
+    libvirt accepts a single event loop implementation per process, so
+    all sessions must be used from the same asyncio loop: a session
+    opened from another loop (for example a second asyncio.run) is
+    refused, its events would be dispatched to the first loop."""
+    global _eventLoop  # pylint: disable=global-statement
+    loop = asyncio.get_running_loop()
+    if _eventLoop is None:
+        _eventLoop = libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+    elif _eventLoop.loop is not loop:
+        raise RuntimeError(
+            "libvirt events are bound to another asyncio loop: use all "
+            "sessions from the same loop."
+        )
+    return _eventLoop
+
+
+class nbdConnection:
+    """libnbd handle driven by the asyncio loop: commands are submitted
+    via the libnbd aio functions and processed as the socket becomes
+    readable or writable, so all connections share a single thread"""
+
+    def __init__(self, handle: nbd.NBD) -> None:
+        self.handle = handle
+        self._loop = asyncio.get_running_loop()
+        self._fd = -1
+        self._watching = {"read": False, "write": False}
+        self._changed = asyncio.Event()
+        self._pending: set = set()
+        self._error: Optional[Exception] = None
+
+    @classmethod
+    async def connect(cls, nbdUri: str) -> "nbdConnection":
+        """Open connection to NBD export"""
+        log.debug("Connecting NBD export: [%s]", nbdUri)
+        conn = cls(nbd.NBD())
+        try:
+            conn.handle.aio_connect_uri(nbdUri)
+            await conn._connected()
+        except (nbd.Error, NbdException) as e:
+            raise NbdConnectionError(f"Unable to connect [{nbdUri}]: [{e}]") from e
+        return conn
+
+    async def _connected(self) -> None:
+        self._update()
+        while self.handle.aio_is_connecting():
+            await self._waitChange()
+        if not self.handle.aio_is_ready():
+            raise NbdException("Connection failed during handshake.")
+
+    async def _waitChange(self) -> None:
+        self._changed.clear()
+        await self._changed.wait()
+        if self._error is not None:
+            raise NbdException(self._error)
+
+    def _watch(self, kind: str, enable: bool) -> None:
+        if self._watching[kind] == enable:
+            return
+        self._watching[kind] = enable
+        add, remove, notify = {
+            "read": (
+                self._loop.add_reader,
+                self._loop.remove_reader,
+                self.handle.aio_notify_read,
+            ),
+            "write": (
+                self._loop.add_writer,
+                self._loop.remove_writer,
+                self.handle.aio_notify_write,
+            ),
+        }[kind]
+        if enable:
+            add(self._fd, self._notify, notify)
+        else:
+            remove(self._fd)
+
+    def _update(self) -> None:
+        """Watch the socket in the direction libnbd is waiting for"""
+        if self._error is not None or self.handle.aio_is_closed():
+            self._stop()
+            return
+        self._fd = self.handle.aio_get_fd()
+        direction = self.handle.aio_get_direction()
+        self._watch("read", bool(direction & nbd.AIO_DIRECTION_READ))
+        self._watch("write", bool(direction & nbd.AIO_DIRECTION_WRITE))
+
+    def _stop(self) -> None:
+        self._watch("read", False)
+        self._watch("write", False)
+
+    def _notify(self, notify: Callable[[], None]) -> None:
+        try:
+            notify()
+        except nbd.Error as e:
+            self._fail(e)
+        self._update()
+        self._changed.set()
+
+    def _fail(self, error: Exception) -> None:
+        """Connection is unusable: fail all commands in flight"""
+        self._error = error
+        for future in list(self._pending):
+            if not future.done():
+                future.set_exception(NbdException(error))
+
+    def _submit(self, func: Callable, *args: Any) -> asyncio.Future:
+        """Submit aio command, the returned future is resolved by
+        the completion callback"""
+        if self._error is not None:
+            raise NbdException(self._error)
+        future = self._loop.create_future()
+
+        def _done(err) -> int:
+            if not future.done():
+                if err.value:
+                    future.set_exception(
+                        NbdException(f"Command failed with error [{err.value}]")
+                    )
+                else:
+                    future.set_result(None)
+            return 1
+
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        try:
+            func(*args, completion=_done)
+        except nbd.Error as e:
+            self._pending.discard(future)
+            raise NbdException(e) from e
+        self._update()
+        return future
+
+    async def pread(self, length: int, offset: int) -> bytearray:
+        """Read length bytes at offset"""
+        buf = nbd.Buffer(length)
+        await self._submit(self.handle.aio_pread, buf, offset)
+        return buf.to_bytearray()
+
+    async def close(self) -> None:
+        """Disconnect after all commands in flight have finished"""
+        if self._error is None and not self.handle.aio_is_closed():
+            try:
+                self.handle.aio_disconnect()
+                self._update()
+                while not (self.handle.aio_is_closed() or self.handle.aio_is_dead()):
+                    await self._waitChange()
+            except (nbd.Error, NbdException) as e:
+                log.debug("Error during NBD shutdown: [%s]", e)
+        self._stop()
+
+
+async def _worker(
+    conn: nbdConnection,
+    writer: Any,
+    work: Any,
+    opt: transfer.copyOptions,
+    stats: transfer.copyStats,
+) -> None:
+    """Read chunks with multiple requests in flight and pass data to
+    the writer in order of submission. Writes are blocking and done in
+    the default executor by transfer.deliver."""
+    inflight: Deque[Tuple[asyncio.Task, int]] = deque()
+    while True:
+        while len(inflight) < opt.requests:
+            item = next(work, None)
+            if item is None:
+                break
+            offset, length = item
+            if opt.limiter is not None:
+                await asyncio.sleep(opt.limiter.reserve(length))
+            inflight.append((asyncio.ensure_future(conn.pread(length, offset)), offset))
+
+        if not inflight:
+            break
+
+        task, offset = inflight.popleft()
+        data = await task
+        await asyncio.to_thread(transfer.deliver, writer, offset, data, opt, stats)
+
+
+async def copy(  # pylint: disable=too-many-arguments
+    target: str,
+    nbdUri: str,
+    writer: Any,
+    ranges: List[Tuple[int, int]],
+    opt: transfer.copyOptions,
+    zeroRanges: Optional[List[Tuple[int, int]]] = None,
+) -> transfer.copyStats:
+    """Copy ranges from NBD export to writer, like transfer.copy but
+    reading via one task per connection instead of threads"""
+    stats = transfer.copyStats(target)
+    work = transfer.chunks(ranges, opt.chunkSize)
+    start = time.monotonic()
+    await asyncio.to_thread(transfer.zero, target, writer, zeroRanges or [], opt, stats)
+    conns: List[nbdConnection] = []
+    try:
+        for _ in range(opt.connections):
+            conns.append(await nbdConnection.connect(nbdUri))
+        tasks = [
+            asyncio.ensure_future(_worker(conn, writer, work, opt, stats))
+            for conn in conns
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+    except Exception as e:  # pylint: disable=broad-except
+        # any reader or writer error must fail the copy
+        raise DiskBackupFailed(f"Copy of disk [{target}] failed: [{e}]") from e
+    finally:
+        for conn in conns:
+            await conn.close()
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+class jobEvents(server.eventHandler):
+    """Track block job and job completed events, the callbacks are
+    invoked from within the asyncio loop via libvirtaio"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    def _update(self, domain: str, event: Dict[str, Any]) -> None:
+        super()._update(domain, event)
+        for future in self._waiters.pop(domain, []):
+            if not future.done():
+                future.set_result(event)
+
+    async def waitJob(
+        self, domain: str, timeout: Optional[float] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Wait until event for domain is received"""
+        event = self.get(domain)
+        if event is not None:
+            return event
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(domain, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class session:
+    """Async interface to create, export, copy and release checkpoints
+    for embedding into other services. The blocking libvirt calls are
+    executed by a thread pool shared by all domains, libvirt events, NBD
+    I/O and external commands are handled by the asyncio loop.
+
+    Keyword arguments override the command line options of the same
+    name, as they would be set by vircpt."""
+
+    def __init__(self, workers: int = 16, **defaults: Any) -> None:
+        self._parser = argparse.ArgumentParser(prog="vircpt")
+        options.addGeneralOptions(self._parser)
+        options.addCommands(self._parser)
+        self._defaults = defaults
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="vircpt")
+        self._client: Optional[client.client] = None
+        self.events = jobEvents()
+
+    async def __aenter__(self) -> "session":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *_exc: Any) -> None:
+        await self.close()
+
+    async def _call(self, func: Callable, *args: Any) -> Any:
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(context.run, func, *args)
+        )
+
+    def _args(
+        self, domain: str, cmd: str, argv: List[str], overrides: Dict[str, Any]
+    ) -> argparse.Namespace:
+        try:
+            args = self._parser.parse_args(["-d", domain, cmd] + argv)
+        except SystemExit as e:
+            raise ValueError(f"Invalid arguments for [{cmd}]: {argv}") from e
+        for key, value in {**self._defaults, **overrides}.items():
+            setattr(args, key, value)
+        return args
+
+    async def open(self) -> None:
+        """Connect libvirt daemon and register for job events"""
+        registerEventLoop()
+        args = self._args("", "list", [], {})
+        self._client = await self._call(client.client, args)
+        await self._call(self._client.registerEvents, self.events)
+
+    async def close(self) -> None:
+        """Close libvirt connection and stop thread pool"""
+        if self._client is not None:
+            await self._call(self._client.close)
+            self._client = None
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def _registry(args: argparse.Namespace) -> registry.registry:
+        return registry.registry(args.statedir, splitList(args.scratchdir))
+
+    def _getDomain(self, name: str) -> libvirt.virDomain:
+        domObj = self._client.getDomain(name)
+        if not domObj.isActive():
+            raise CheckpointException(f"Virtual machine [{name}] must be running.")
+        return domObj
+
+    def _getDisks(self, args: argparse.Namespace, domObj) -> List[client.DomainDisk]:
+        diskList = self._client.getDomainDisks(
+            args, self._client.getDomainConfig(domObj)
+        )
+        for disk in diskList:
+            client.diskSize(domObj, disk)
+        return diskList
+
+    def _checkpointDisks(self, domObj, name: str) -> List[client.DomainDisk]:
+        cpt = checkpoint.exists(domObj, name)
+        diskList = self._client.getDomainDisksFromCheckpoint(cpt.getXMLDesc())
+        for disk in diskList:
+            client.diskSize(domObj, disk)
+        return diskList
+
+    @staticmethod
+    def _frozen(args: argparse.Namespace, domObj, func: Callable, xml: str) -> bool:
+        with fs.freezeWindow(domObj, args.freeze_deadline) as window:
+            func(domObj, xml)
+        return window.expired
+
+    async def create(
+        self, domain: str, name: str, **overrides: Any
+    ) -> List[client.DomainDisk]:
+        """Create checkpoint, returns the disks covered by it"""
+        args = self._args(domain, "create", ["--name", name], overrides)
+        domObj = await self._call(self._getDomain, domain)
+        diskList = await self._call(self._getDisks, args, domObj)
+        cptXml = checkpoint.checkpointXml(args, diskList)
+        if await self._call(self._frozen, args, domObj, checkpoint.create, cptXml):
+            await self._call(lambda: checkpoint.exists(domObj, name).delete())
+            raise CheckpointException(
+                f"Checkpoint [{name}] removed: freeze deadline exceeded."
+            )
+        if args.keep or args.max_age:
+            await self._call(checkpoint.prune, args, domObj)
+        return diskList
+
+    async def export(self, domain: str, name: str, **overrides: Any) -> str:
+        """Start NBD export for checkpoint, returns the unix socket
+        or URI of the NBD server"""
+        args = self._args(domain, "export", ["--name", name], overrides)
+        args.socketfile = f"{args.socketdir}/vircpt.{domain}.{name}"
+        domObj = await self._call(self._getDomain, domain)
+        diskList = await self._call(self._checkpointDisks, domObj, name)
+        if await self._call(self._client.blockJobActive, domObj, diskList):
+            raise CheckpointException(
+                "Block job already active: release the running export first."
+            )
+        backupXml = await self._call(checkpoint.exportXml, args, domObj, diskList)
+        scratchFiles = checkpoint.preallocated(args, diskList)
+        self.events.clear(domain)
+        if await self._call(
+            self._frozen,
+            args,
+            domObj,
+            partial(checkpoint.export, scratchFiles=scratchFiles),
+            backupXml,
+        ):
+            await self._call(self._client.stopExport, domObj)
+            await self._call(
+                registry.removeScratch, scratchFiles, splitList(args.scratchdir)
+            )
+            raise CheckpointException("Export stopped: freeze deadline exceeded.")
+        if args.transport == "tcp":
+            args.socketfile = checkpoint.exportUri(args)
+        entry = registry.exportEntry(
+            domain=domain,
+            checkpoint=name,
+            socket=args.socketfile,
+            started=time.time(),
+            disks=[disk.target for disk in diskList],
+            scratch=[disk.scratch for disk in diskList],
+            base=args.since or "",
+        )
+        await self._call(self._registry(args).add, entry)
+        return args.socketfile
+
+    async def _copyDisk(
+        self,
+        args: argparse.Namespace,
+        domObj,
+        limiter: transfer.rateLimiter,
+        disk: client.DomainDisk,
+    ) -> transfer.copyStats:
+        plan = await self._call(backup.planCopy, args, domObj, disk)
+        writer = await self._call(backup.openTarget, args, disk, plan)
+        try:
+            stats = await copy(
+                disk.target,
+                plan.nbdUri,
+                writer,
+                plan.ranges,
+                backup.copyOptions(args, limiter, plan),
+                plan.zeroRanges,
+            )
+        finally:
+            await self._call(backup.closeTarget, writer, plan)
+        backup.finishCopy(disk, plan, stats)
+        return stats
+
+    async def copy(self, domain: str, **overrides: Any) -> Dict[str, Any]:
+        """Copy disks of the active export into backup images in the
+        current directory like nbdcopy, returns copy statistics per disk"""
+        args = self._args(domain, "nbdcopy", [], overrides)
+        if args.incremental and args.format == "raw":
+            raise BackupException("Incremental backup requires qcow2 or stream format.")
+        entry = await self._call(self._registry(args).lookup, domain)
+        if entry is None:
+            raise BackupException(f"No active export found for domain [{domain}].")
+        args.name = entry.checkpoint
+        args.socketfile = entry.socket
+        args.started = entry.started
+        args.since = entry.base
+        currentDomain.set(domain)
+        domObj = await self._call(self._getDomain, domain)
+        diskList = await self._call(self._checkpointDisks, domObj, args.name)
+        limiter, throttler = await self._call(backup.rateLimit, args, domObj, diskList)
+        jobs = asyncio.Semaphore(args.jobs)
+
+        async def _run(disk: client.DomainDisk) -> transfer.copyStats:
+            async with jobs:
+                return await self._copyDisk(args, domObj, limiter, disk)
+
+        try:
+            result = await asyncio.gather(*(_run(disk) for disk in diskList))
+        finally:
+            if throttler is not None:
+                await self._call(throttler.stop)
+        return {disk.target: stats for disk, stats in zip(diskList, result)}
+
+    async def release(self, domain: str, **overrides: Any) -> None:
+        """Stop NBD export of domain"""
+        args = self._args(domain, "release", [], overrides)
+        domObj = await self._call(self._getDomain, domain)
+        self.events.clear(domain)
+        await self._call(self._client.stopExport, domObj)
+        await self._call(self._registry(args).release, domain)
+
+    async def wait(
+        self, domain: str, timeout: Optional[float] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Wait for the block job or job completed event of domain"""
+        return await self.events.waitJob(domain, timeout)
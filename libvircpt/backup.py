@@ -0,0 +1,428 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import logging
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import chain
+from typing import List, Optional, Tuple
+import nbd
+from libvircpt import checkpoint
+from libvircpt import nbdcli
+from libvircpt import extents
+from libvircpt import transfer
+from libvircpt import throttle
+from libvircpt import journal
+from libvircpt import metrics
+from libvircpt import chunkstream
+from libvircpt import chunkstore
+from libvircpt.common import runParallel, splitList
+from libvircpt.client import diskSize
+from libvircpt.exceptions import (
+    BackupException,
+    NbdException,
+    RestoreException,
+)
+
+log = logging.getLogger("backup")
+
+
+def _account(operation: str, stats, ranges) -> None:
+    """Record duration, bytes and extents of disk copy"""
+    metrics.collector.observe(operation, stats.elapsed, disk=stats.target)
+    metrics.collector.add("bytes", stats.bytes, disk=stats.target, operation=operation)
+    metrics.collector.add(
+        "skipped", stats.skipped, disk=stats.target, operation=operation
+    )
+    metrics.collector.add(
+        "extents", len(ranges), disk=stats.target, operation=operation
+    )
+
+
+def getBaseCheckpoint(args, domObj) -> str:
+    """Return checkpoint the incremental backup is based on"""
+    parent = checkpoint.getBase(args, domObj)
+    if parent == args.name:
+        raise BackupException(
+            f"Checkpoint [{args.name}] has no parent: full backup required."
+        )
+    return parent
+
+
+def getBackingFile(parent: str, disk) -> str:
+    """Find the backup image of the checkpoint the export is based on,
+    which is used as backing file for an incremental backup. Backup
+    images carry the checkpoint name, so an image of another checkpoint
+    is never used as base."""
+    file = f"backup-{disk.target}.{parent}.qcow2"
+    if os.path.exists(file):
+        return file
+
+    raise BackupException(
+        f"Unable to find backup [{file}] for parent checkpoint [{parent}]: "
+        "full backup required."
+    )
+
+
+@dataclass
+class copyPlan:  # pylint: disable=too-many-instance-attributes
+    """Target and ranges of a disk copy, shared by nbdcopy and the
+    async API"""
+
+    nbdUri: str
+    file: str
+    base: Optional[str] = None
+    backingFile: Optional[str] = None
+    ranges: List[Tuple[int, int]] = field(default_factory=list)
+    zeroRanges: List[Tuple[int, int]] = field(default_factory=list)
+    jrnl: Optional[journal.journal] = None
+    resume: bool = False
+
+
+def planCopy(args, domObj, disk) -> copyPlan:
+    """Determine target image, backing file and the ranges to copy.
+    For incremental backups only extents marked dirty are copied,
+    ranges reported as zero by base:allocation are not read.
+
+    Copied extents are recorded in a journal next to raw and qcow2
+    images: if the copy is interrupted, the next run for the same
+    export continues with the remaining extents."""
+    plan = copyPlan(
+        nbdcli.uri(args.socketfile, disk.target),
+        f"backup-{disk.target}.{args.name}.{args.format}",
+    )
+    ranges = [(0, disk.size)]
+    if args.incremental:
+        plan.base = getBaseCheckpoint(args, domObj)
+        if args.format == "qcow2":
+            plan.backingFile = getBackingFile(plan.base, disk)
+        ranges = dirtyRanges(plan.nbdUri, args.name)
+        log.info(
+            "Disk: [%s]: [%s] dirty bytes in [%s] extents based on [%s], "
+            "backing file: [%s]",
+            disk.target,
+            sum(length for _, length in ranges),
+            len(ranges),
+            plan.base,
+            plan.backingFile,
+        )
+    plan.ranges, plan.zeroRanges = planRanges(plan.nbdUri, ranges)
+    log.info(
+        "Disk: [%s]: [%s], [%s] bytes data, [%s] bytes zero",
+        disk.target,
+        plan.file,
+        sum(length for _, length in plan.ranges),
+        sum(length for _, length in plan.zeroRanges),
+    )
+    if args.format == "stream":
+        return plan
+
+    plan.jrnl = journal.journal(
+        plan.file,
+        {
+            "domain": args.domain,
+            "checkpoint": args.name,
+            "started": args.started,
+            "disk": disk.target,
+            "size": disk.size,
+            "format": args.format,
+            "incremental": args.incremental,
+        },
+    )
+    if plan.jrnl.load() and os.path.exists(plan.file):
+        plan.ranges = journal.subtract(plan.ranges, plan.jrnl.done)
+        plan.zeroRanges = journal.subtract(plan.zeroRanges, plan.jrnl.done)
+        plan.resume = True
+        log.info(
+            "Disk: [%s]: resuming copy, [%s] bytes left to copy.",
+            disk.target,
+            sum(length for _, length in plan.ranges),
+        )
+    else:
+        plan.jrnl.done = []
+    return plan
+
+
+def openTarget(args, disk, plan: copyPlan):
+    """Create target image or open it to resume an interrupted copy"""
+    if plan.resume:
+        return transfer.openTarget(plan.file, disk.size, args.format)
+    return transfer.openWriter(
+        plan.file,
+        disk.size,
+        args.format,
+        plan.backingFile,
+        args.compress_level,
+        {"checkpoint": args.name, "incremental": args.incremental, "base": plan.base},
+    )
+
+
+def copyOptions(args, limiter, plan: copyPlan) -> transfer.copyOptions:
+    """Copy options for plan: full backups are written into new sparse
+    images, zero ranges of incremental backups must be written"""
+    return transfer.copyOptions(
+        args.connections,
+        args.requests,
+        limiter,
+        progress=plan.jrnl.record if plan.jrnl is not None else None,
+        sparse=not args.incremental,
+        detectZeroes=True,
+    )
+
+
+def closeTarget(writer, plan: copyPlan) -> None:
+    """Close target and save copy progress"""
+    writer.close()
+    if plan.jrnl is not None:
+        plan.jrnl.save()
+
+
+def finishCopy(disk, plan: copyPlan, stats: transfer.copyStats) -> None:
+    """Remove journal of finished copy and account statistics"""
+    if plan.jrnl is not None:
+        plan.jrnl.remove()
+    _account("copy", stats, plan.ranges)
+    log.info(
+        "Disk: [%s]: copied [%s] bytes, skipped [%s] zero bytes in [%.2f] "
+        "seconds: [%.2f] MiB/s",
+        disk.target,
+        stats.bytes,
+        stats.skipped,
+        stats.elapsed,
+        stats.throughput,
+    )
+
+
+def copyDisk(args, domObj, limiter, disk) -> None:
+    """Copy disk image from NBD export into backup image, for
+    incremental backups only extents marked dirty are copied into
+    an overlay image using the last backup as backing file, or
+    into a stream file which records the copied extents."""
+    diskSize(domObj, disk)
+    try:
+        plan = planCopy(args, domObj, disk)
+        writer = openTarget(args, disk, plan)
+        try:
+            stats = transfer.copy(
+                disk.target,
+                plan.nbdUri,
+                writer,
+                plan.ranges,
+                copyOptions(args, limiter, plan),
+                plan.zeroRanges,
+            )
+        finally:
+            closeTarget(writer, plan)
+    except (BackupException, NbdException, nbd.Error) as e:
+        log.error("Failed to copy disk [%s]: [%s]", disk.target, e)
+        return
+
+    finishCopy(disk, plan, stats)
+
+
+def rateLimit(args, domObj, diskList):
+    """Return rate limiter shared by all disks and the started throttle
+    adjusting it to the guest load in adaptive mode, which must be
+    stopped after copy"""
+    maxRate = args.max_rate * 1024 * 1024
+    limiter = transfer.rateLimiter(maxRate)
+    throttler = None
+    if args.adaptive:
+        maxRate = maxRate or 1024 * 1024 * 1024
+        limiter.setRate(maxRate)
+        throttler = throttle.adaptiveThrottle(
+            domObj,
+            [disk.target for disk in diskList],
+            limiter,
+            args.max_latency,
+        )
+        throttler.start()
+    return limiter, throttler
+
+
+def copyDisks(args, domObj, diskList, func) -> None:
+    """Run copy function for all disks with a shared rate limiter,
+    adjusted by the guest load in adaptive mode"""
+    limiter, throttler = rateLimit(args, domObj, diskList)
+    try:
+        runParallel(partial(func, args, domObj, limiter), diskList, args.jobs)
+    finally:
+        if throttler is not None:
+            throttler.stop()
+
+
+def dirtyRanges(nbdUri, name):
+    """Return ranges marked dirty in the bitmap of checkpoint"""
+    handle = nbdcli.connect(nbdUri, [f"{extents.BITMAP_PREFIX}{name}"])
+    try:
+        return extents.dirty(handle, name)
+    finally:
+        nbdcli.disconnect(handle)
+
+
+def planRanges(nbdUri, ranges):
+    """Split ranges into data and zero ranges as reported by
+    base:allocation, zero ranges do not have to be read"""
+    handle = nbdcli.connect(nbdUri, [extents.BASE_ALLOCATION])
+    try:
+        return extents.split(ranges, extents.query(handle, extents.BASE_ALLOCATION))
+    finally:
+        nbdcli.disconnect(handle)
+
+
+def storeDisk(args, domObj, limiter, disk) -> None:
+    """Copy disk into content addressed chunk store, only chunks not
+    yet existent in the store are written"""
+    diskSize(domObj, disk)
+    nbdUri = nbdcli.uri(args.socketfile, disk.target)
+    ranges = [(0, disk.size)]
+    try:
+        chunkStore = chunkstore.store(args.store)
+        base = None
+        if args.incremental:
+            parent = checkpoint.getBase(args, domObj)
+            if parent == args.name:
+                raise BackupException(
+                    f"Checkpoint [{args.name}] has no parent: full backup required."
+                )
+            base = chunkstore.loadManifest(
+                chunkStore.manifestPath(args.domain, parent, disk.target)
+            )
+            ranges = extents.align(
+                dirtyRanges(nbdUri, args.name), args.chunk_size, disk.size
+            )
+        writer = chunkstore.storeWriter(chunkStore, disk.size, args.chunk_size, base)
+        stats = transfer.copy(
+            disk.target,
+            nbdUri,
+            writer,
+            ranges,
+            transfer.copyOptions(
+                args.connections, args.requests, limiter, args.chunk_size
+            ),
+        )
+        manifestFile = chunkStore.manifestPath(args.domain, args.name, disk.target)
+        chunkStore.saveManifest(
+            manifestFile,
+            writer.manifest(domain=args.domain, checkpoint=args.name, disk=disk.target),
+        )
+    except (BackupException, RestoreException, NbdException, nbd.Error, OSError) as e:
+        log.error("Failed to store disk [%s]: [%s]", disk.target, e)
+        return
+
+    _account("store", stats, ranges)
+    log.info(
+        "Disk: [%s]: read [%s] bytes in [%.2f] seconds: [%s] bytes new, "
+        "[%s] bytes duplicate: manifest [%s]",
+        disk.target,
+        stats.bytes,
+        stats.elapsed,
+        writer.written,
+        writer.duplicate,
+        manifestFile,
+    )
+
+
+def _syncState(target: str) -> str:
+    return f"{target}.vircpt"
+
+
+def syncDisk(args, domObj, limiter, disk) -> None:
+    """Write extents marked dirty into existing target image in place.
+    The checkpoint the target has been synced to last is recorded next
+    to the target, syncing is refused if it is neither the parent of the
+    exported checkpoint nor the exported checkpoint itself."""
+    diskSize(domObj, disk)
+    nbdUri = nbdcli.uri(args.socketfile, disk.target)
+    target = args.target.format(disk=disk.target, name=args.name)
+    imageFormat = "qcow2" if target.endswith(".qcow2") else "raw"
+    try:
+        if not os.path.exists(target):
+            raise BackupException(f"Target image [{target}] does not exist.")
+        parent = checkpoint.getBase(args, domObj)
+        try:
+            with open(_syncState(target), "r", encoding="utf-8") as fh:
+                synced = json.load(fh)["checkpoint"]
+            if synced not in (parent, args.name):
+                raise BackupException(
+                    f"Target [{target}] is at checkpoint [{synced}], "
+                    f"exported checkpoint is based on [{parent}]."
+                )
+        except FileNotFoundError:
+            log.warning("No sync state for target [%s]: not checked.", target)
+
+        ranges, zeroRanges = planRanges(nbdUri, dirtyRanges(nbdUri, args.name))
+        writer = transfer.openTarget(target, disk.size, imageFormat)
+        try:
+            stats = transfer.copy(
+                disk.target,
+                nbdUri,
+                writer,
+                ranges,
+                transfer.copyOptions(
+                    args.connections, args.requests, limiter, detectZeroes=True
+                ),
+                zeroRanges,
+            )
+        finally:
+            writer.close()
+        with open(_syncState(target), "w", encoding="utf-8") as fh:
+            json.dump({"checkpoint": args.name, "size": disk.size}, fh)
+    except (BackupException, NbdException, nbd.Error, OSError, ValueError) as e:
+        log.error("Failed to sync disk [%s]: [%s]", disk.target, e)
+        return
+
+    _account("sync", stats, ranges)
+    log.info(
+        "Disk: [%s]: wrote [%s] bytes and [%s] zero bytes in [%s] extents to "
+        "[%s] in [%.2f] seconds",
+        disk.target,
+        stats.bytes,
+        stats.skipped,
+        len(ranges) + len(zeroRanges),
+        target,
+        stats.elapsed,
+    )
+
+
+def restore(args) -> None:
+    """Rebuild image from chunk store manifest or stream files. Stream
+    files of incremental backups only contain the changed extents, they
+    are applied in order on top of the full backup they are based on."""
+    try:
+        if args.source.endswith(".stream"):
+            readers = chunkstream.chain(splitList(args.source))
+            size = readers[-1].size
+            data = chain.from_iterable(reader.frames() for reader in readers)
+        else:
+            manifest = chunkstore.loadManifest(args.source)
+            storePath = args.store
+            if storePath is None:
+                # manifests/<domain>/<checkpoint>/<disk>.json
+                storePath = os.path.abspath(os.path.join(args.source, *[".."] * 4))
+            size = manifest["size"]
+            data = chunkstore.chunks(chunkstore.store(storePath), manifest)
+        log.info("Restore [%s] to [%s]", args.source, args.target)
+        writer = transfer.openWriter(args.target, size, args.format)
+        try:
+            for offset, chunk in data:
+                writer.write(offset, chunk)
+        finally:
+            writer.close()
+    except (BackupException, RestoreException, NbdException, OSError) as e:
+        log.error("Failed to restore [%s]: [%s]", args.source, e)
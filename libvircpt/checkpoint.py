@@ -14,14 +14,25 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import os
+import copy
+import time
 import random
 import string
+import errno
+import socket
 import logging
+from urllib.parse import urlsplit
 from argparse import Namespace
-from typing import Any, List
+from typing import Any, Dict, List, Optional
 from lxml import etree as ElementTree
 import libvirt
 from libvircpt import xml
+from libvircpt import scratch
+from libvircpt import registry
+from libvircpt import metrics
+from libvircpt.common import splitList
+from libvircpt.exceptions import CheckpointException, ScratchSpaceError
 
 log = logging.getLogger()
 
@@ -43,12 +54,12 @@ def getXml(cptObj: libvirt.virDomainCheckpoint) -> str:
         return cptObj.getXMLDesc()
 
 
-def delete(args: Namespace, cptObj: libvirt.virDomainCheckpoint) -> bool:
-    """Delete checkpoint"""
+def delete(cptObj: libvirt.virDomainCheckpoint, metadata: bool = False) -> bool:
+    """Delete checkpoint, or its metadata only"""
     checkpointName = cptObj.getName()
 
     flags = 0
-    if args.metadata is True:
+    if metadata is True:
         flags = libvirt.VIR_DOMAIN_CHECKPOINT_DELETE_METADATA_ONLY
         log.debug("Attempt to remove checkpoint metadata: [%s]", checkpointName)
     else:
@@ -86,16 +97,140 @@ def _createCheckpointXml(diskList: List[Any], checkpointName: str) -> str:
     return xml.indent(top)
 
 
-def create(args: Namespace, domObj: libvirt.virDomain, diskList):
+def checkpointXml(args: Namespace, diskList: List[Any]) -> str:
+    """Prepare checkpoint XML, done before filesystems are frozen"""
+    return _createCheckpointXml(diskList, args.name)
+
+
+def create(domObj: libvirt.virDomain, cptXml: str) -> None:
     """Create checkpoint"""
-    domObj.checkpointCreateXML(_createCheckpointXml(diskList, args.name))
+    with metrics.collector.phase("checkpointCreateXML"):
+        domObj.checkpointCreateXML(cptXml)
+
+
+def info(domObj: libvirt.virDomain) -> List[Dict[str, Any]]:
+    """Return checkpoints in topological order (parents before their
+    children) including parent, creation time and the per disk size
+    of data changed since the checkpoint was created."""
+    cpts = domObj.listAllCheckpoints(libvirt.VIR_DOMAIN_CHECKPOINT_LIST_TOPOLOGICAL)
+    result = []
+    for cpt in cpts:
+        tree = xml.asTree(getXml(cpt))
+        parent = tree.findtext("parent/name")
+        creationTime = tree.findtext("creationTime")
+        disks = []
+        for disk in tree.xpath("disks/disk"):
+            if disk.get("checkpoint") == "no":
+                continue
+            size = disk.get("size")
+            disks.append(
+                {
+                    "name": disk.get("name"),
+                    "bitmap": disk.get("bitmap"),
+                    "size": int(size) if size is not None else None,
+                }
+            )
+        result.append(
+            {
+                "name": cpt.getName(),
+                "parent": parent,
+                "creationTime": int(creationTime) if creationTime else None,
+                "disks": disks,
+            }
+        )
 
+    return result
 
-def show(domObj: libvirt.virDomain):
+
+def show(domObj: libvirt.virDomain) -> List[Dict[str, Any]]:
     """list checkpoints"""
-    cpts = domObj.listAllCheckpoints()
+    cpts = info(domObj)
+    for cpt in cpts:
+        logging.info(
+            " + %s (parent: %s, created: %s)",
+            cpt["name"],
+            cpt["parent"],
+            cpt["creationTime"],
+        )
+        for disk in cpt["disks"]:
+            logging.info("   [%s]: dirty: [%sB]", disk["name"], disk["size"])
+    showBitmaps(cpts)
+
+    return cpts
+
+
+def bitmapCount(cpts: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Return number of active dirty bitmaps per disk, each bitmap must
+    be updated by qemu for every guest write to the disk"""
+    result: Dict[str, int] = {}
     for cpt in cpts:
-        logging.info(" + %s", cpt.getName())
+        for disk in cpt["disks"]:
+            result[disk["name"]] = result.get(disk["name"], 0) + 1
+    return result
+
+
+def showBitmaps(cpts: List[Dict[str, Any]]) -> None:
+    """Log number of active dirty bitmaps per disk"""
+    for disk, count in sorted(bitmapCount(cpts).items()):
+        logging.info(" [%s]: active bitmaps: [%s]", disk, count)
+
+
+def expired(
+    cpts: List[Dict[str, Any]],
+    keep: int,
+    maxAge: float,
+    protected: List[str],
+    now: Optional[float] = None,
+) -> List[str]:
+    """Return checkpoints not covered by the retention policy, oldest
+    first: checkpoints are kept if they are one of the last keep
+    checkpoints or younger than maxAge hours. The latest checkpoint,
+    required for the next incremental backup, and protected
+    checkpoints are always kept."""
+    if not keep and not maxAge:
+        return []
+    if now is None:
+        now = time.time()
+    ordered = sorted(cpts, key=lambda cpt: cpt["creationTime"] or 0)
+    result = []
+    for pos, cpt in enumerate(ordered[:-1]):
+        if cpt["name"] in protected:
+            continue
+        if keep and pos >= len(ordered) - keep:
+            continue
+        if maxAge and now - (cpt["creationTime"] or 0) < maxAge * 3600:
+            continue
+        result.append(cpt["name"])
+    return result
+
+
+def _protected(args: Namespace, domObj: libvirt.virDomain) -> List[str]:
+    """Return checkpoints used by the active export of the domain"""
+    entry = registry.registry(args.statedir).get(args.domain)
+    if entry is None:
+        return []
+    exportArgs = copy.copy(args)
+    exportArgs.name = entry.checkpoint
+    exportArgs.since = entry.base
+    return [entry.checkpoint, getBase(exportArgs, domObj)]
+
+
+def prune(args: Namespace, domObj: libvirt.virDomain, metadata: bool = False) -> bool:
+    """Apply retention policy. Checkpoints are removed oldest first:
+    libvirt merges the bitmap of a removed checkpoint into its parent,
+    so the bitmaps of the remaining checkpoints stay complete. The
+    checkpoints used by an active export are kept. If metadata is set,
+    only the checkpoint metadata is removed."""
+    cpts = info(domObj)
+    result = True
+    for name in expired(cpts, args.keep, args.max_age, _protected(args, domObj)):
+        log.info("Removing checkpoint [%s]: expired by retention policy.", name)
+        if not delete(exists(domObj, name), metadata):
+            result = False
+            break
+
+    showBitmaps(info(domObj))
+    return result
 
 
 def getParent(args: Namespace, domObj):
@@ -110,15 +245,44 @@ def getParent(args: Namespace, domObj):
     return parent
 
 
+def getBase(args: Namespace, domObj) -> str:
+    """Return checkpoint used as incremental entry point for the export:
+    the checkpoint passed via --since, which must be an ancestor of the
+    exported checkpoint, or its parent. Libvirt merges the bitmaps of
+    all checkpoints in between."""
+    since = getattr(args, "since", None)
+    if not since or since == args.name:
+        return getParent(args, domObj)
+
+    cptObj = exists(domObj, args.name)
+    while True:
+        try:
+            cptObj = cptObj.getParent()
+        except libvirt.libvirtError as e:
+            raise CheckpointException(
+                f"Checkpoint [{since}] is not an ancestor of [{args.name}]."
+            ) from e
+        if cptObj.getName() == since:
+            return since
+
+
 def _createExportXml(args: Namespace, domObj: libvirt.virDomain, diskList) -> str:
     """Create xml required for exporting checkpoint. If an parent checkpoint
     exists, add the required incremental flags to the backupBegin call so the
-    exported bitmap contains the changes to the last checkpoint."""
-    parent = getParent(args, domObj)
+    exported bitmap contains the changes to the last checkpoint, or to the
+    older checkpoint passed via --since."""
+    parent = getBase(args, domObj)
     top = ElementTree.Element("domainbackup", {"mode": "pull"})
-    ElementTree.SubElement(
-        top, "server", {"transport": "unix", "socket": f"{args.socketfile}"}
-    )
+    server = {"transport": "unix", "socket": f"{args.socketfile}"}
+    if args.transport == "tcp":
+        server = {
+            "transport": "tcp",
+            "name": args.listen_address,
+            "port": f"{args.port}",
+        }
+        if args.tls:
+            server["tls"] = "yes"
+    ElementTree.SubElement(top, "server", server)
 
     if parent != args.name:
         incremental = ElementTree.SubElement(top, "incremental")
@@ -128,28 +292,125 @@ def _createExportXml(args: Namespace, domObj: libvirt.virDomain, diskList) -> st
         parent = args.name
 
     disks = ElementTree.SubElement(top, "disks")
+    scratchDirs = scratch.placement(
+        splitList(args.scratchdir), args.scratch_balance, args.scratch_reserve
+    )
 
     for disk in diskList:
         scratchId = "".join(random.choices(string.ascii_uppercase + string.digits, k=5))
-        scratchFile = f"{args.scratchdir}/backup.{scratchId}.{disk.target}"
+        scratchDir = scratchDirs.choose(disk.size)
+        scratchFile = f"{scratchDir}/backup.{scratchId}.{disk.target}"
         log.debug("Using scratch file: %s", scratchFile)
+        disk.scratch = scratchFile
         dE = ElementTree.SubElement(
             disks,
             "disk",
             {"name": disk.target, "exportbitmap": args.name, "incremental": parent},
         )
-        ElementTree.SubElement(dE, "scratch", {"file": f"{scratchFile}"})
+        scratchE = ElementTree.SubElement(dE, "scratch", {"file": f"{scratchFile}"})
+        if args.scratch_preallocate:
+            ElementTree.SubElement(scratchE, "driver", {"type": "qcow2"})
 
     return xml.indent(top)
 
 
+def _portInUse(address: str, port: int) -> bool:
+    """Check if port is already bound on this host"""
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind((address, port))
+        except OSError as e:
+            return e.errno == errno.EADDRINUSE
+    return False
+
+
+def _choosePort(args: Namespace) -> int:
+    """Return first port of the port range which is not used by another
+    export. If libvirt runs on this host, ports bound by other services
+    are skipped too, for remote hypervisors libvirt reports if the port
+    can not be bound."""
+    first, _, last = args.port_range.partition("-")
+    used = set()
+    for entry in registry.registry(args.statedir).entries():
+        if "://" in entry.socket and entry.domain != args.domain:
+            used.add(urlsplit(entry.socket).port)
+    local = not urlsplit(args.uri).hostname
+    for port in range(int(first), int(last or first) + 1):
+        if port in used:
+            continue
+        if local and _portInUse(args.listen_address, port):
+            continue
+        return port
+
+    raise CheckpointException(f"No free port in range [{args.port_range}].")
+
+
+def exportUri(args: Namespace) -> str:
+    """Return URI of TCP export: clients connect to the bind address or,
+    if bound to all addresses, to the host libvirt is connected to"""
+    host = args.listen_address
+    if host in ("0.0.0.0", "::"):
+        host = urlsplit(args.uri).hostname or socket.gethostname()
+    if ":" in host:
+        host = f"[{host}]"
+    if not args.tls:
+        return f"nbd://{host}:{args.port}"
+    query = ""
+    if args.tls_certificates:
+        query = f"?tls-certificates={args.tls_certificates}"
+    return f"nbds://{host}:{args.port}{query}"
+
+
+def exportXml(args: Namespace, domObj: libvirt.virDomain, diskList: List[Any]) -> str:
+    """Prepare export XML including parent lookup, scratch file
+    placement and port selection, done before filesystems are frozen"""
+    if args.transport == "tcp":
+        args.port = _choosePort(args)
+    backupXml = _createExportXml(args, domObj, diskList)
+    _preallocate(preallocated(args, diskList), diskList, splitList(args.scratchdir))
+    return backupXml
+
+
+def preallocated(args: Namespace, diskList: List[Any]) -> List[str]:
+    """Return scratch files created by vircpt instead of libvirt"""
+    if not args.scratch_preallocate:
+        return []
+    return [disk.scratch for disk in diskList]
+
+
+def _preallocate(
+    scratchFiles: List[str], diskList: List[Any], scratchDirs: List[str]
+) -> None:
+    created: List[str] = []
+    try:
+        for scratchFile, disk in zip(scratchFiles, diskList):
+            created.append(scratchFile)
+            scratch.create(scratchFile, disk.size)
+    except ScratchSpaceError:
+        registry.removeScratch(created, scratchDirs)
+        raise
+
+
 def export(
-    args: Namespace,
     domObj: libvirt.virDomain,
-    diskList: List[Any],
+    backupXml: str,
+    scratchFiles: Optional[List[str]] = None,
 ) -> None:
-    """Export checkpoint data via NBD"""
-    exportXml = _createExportXml(args, domObj, diskList)
+    """Export checkpoint data via NBD, preallocated scratch files are
+    reused by libvirt and removed if the export can not be started"""
     log.debug("Starting checkpoint export via API.")
-    domObj.backupBegin(exportXml, None)
+    flags = 0
+    if scratchFiles:
+        flags = libvirt.VIR_DOMAIN_BACKUP_BEGIN_REUSE_EXTERNAL
+    try:
+        with metrics.collector.phase("backupBegin"):
+            domObj.backupBegin(backupXml, None, flags)
+    except libvirt.libvirtError:
+        scratchFiles = scratchFiles or []
+        # files created by exportXml within the scratch directories
+        registry.removeScratch(
+            scratchFiles, [os.path.dirname(scratchFile) for scratchFile in scratchFiles]
+        )
+        raise
     log.debug("Started export via API.")
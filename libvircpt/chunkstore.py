@@ -0,0 +1,201 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Iterator, Optional, Set, Tuple, Union
+from libvircpt.exceptions import DiskBackupWriterException, RestoreError
+
+log = logging.getLogger("chunkstore")
+
+# chunk size used to split disks, smaller chunks increase the
+# chance of finding duplicates but require more metadata
+CHUNK_SIZE = 1024 * 1024
+
+
+def _fsyncDir(path: str) -> None:
+    """Persist directory entries of files renamed into directory"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _tmpName(path: str) -> str:
+    """Return temporary file name unique across processes and threads
+    writing into the same store"""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+class store:
+    """Content addressed chunk store: chunks are stored once, named
+    by their sha256 digest. Manifests map disk offsets to chunks for
+    each domain, checkpoint and disk.
+
+    Chunks are synced to disk when written, the directories they have
+    been added to are synced before a manifest referencing them is
+    published, so after a crash manifests never point to lost chunks."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._dirty: Set[str] = set()
+        self._lock = threading.Lock()
+        self.chunkDir = os.path.join(path, "chunks")
+        self.manifestDir = os.path.join(path, "manifests")
+        try:
+            os.makedirs(self.chunkDir, exist_ok=True)
+            os.makedirs(self.manifestDir, exist_ok=True)
+        except OSError as e:
+            raise DiskBackupWriterException(
+                f"Unable to create chunk store [{path}]: [{e}]"
+            ) from e
+
+    def chunkPath(self, digest: str) -> str:
+        """Return path of chunk, chunks are spread across sub directories"""
+        return os.path.join(self.chunkDir, digest[:2], digest[2:4], digest)
+
+    def put(self, data: Union[bytes, bytearray]) -> Tuple[str, bool]:
+        """Store chunk if not existent, return digest and whether the
+        chunk has been written"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunkPath(digest)
+        if os.path.exists(path):
+            return digest, False
+
+        directory = os.path.dirname(path)
+        dirty = {directory}
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+            # entries of created sub directories must be persisted, too
+            dirty.update({self.chunkDir, os.path.dirname(directory)})
+        tmpFile = _tmpName(path)
+        with open(tmpFile, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpFile, path)
+        with self._lock:
+            self._dirty.update(dirty)
+        return digest, True
+
+    def sync(self) -> None:
+        """Persist directory entries of chunks written so far"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for directory in sorted(dirty):
+            _fsyncDir(directory)
+
+    def get(self, digest: str) -> bytes:
+        """Return chunk data"""
+        try:
+            with open(self.chunkPath(digest), "rb") as fh:
+                return fh.read()
+        except OSError as e:
+            raise RestoreError(f"Unable to read chunk [{digest}]: [{e}]") from e
+
+    def manifestPath(self, domain: str, checkpoint: str, disk: str) -> str:
+        """Return path of manifest for disk of checkpoint"""
+        return os.path.join(self.manifestDir, domain, checkpoint, f"{disk}.json")
+
+    def saveManifest(self, path: str, manifest: Dict[str, Any]) -> None:
+        """Write manifest atomically after all chunks are persisted"""
+        self.sync()
+        directory = os.path.dirname(path)
+        created = not os.path.isdir(directory)
+        os.makedirs(directory, exist_ok=True)
+        tmpFile = _tmpName(path)
+        with open(tmpFile, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpFile, path)
+        _fsyncDir(directory)
+        if created:
+            # manifests/<domain>/<checkpoint>
+            _fsyncDir(os.path.dirname(directory))
+            _fsyncDir(self.manifestDir)
+
+
+def loadManifest(path: str) -> Dict[str, Any]:
+    """Read manifest"""
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError) as e:
+        raise RestoreError(f"Unable to read manifest [{path}]: [{e}]") from e
+
+
+class storeWriter:
+    """Writer storing the copied data as chunks, used by the copy
+    engine. For incremental backups the chunk map of the parent
+    manifest is used as base, so each manifest describes the
+    complete disk."""
+
+    def __init__(
+        self,
+        chunkStore: store,
+        size: int,
+        chunkSize: int = CHUNK_SIZE,
+        base: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.store = chunkStore
+        self.size = size
+        self.chunkSize = chunkSize
+        self.chunks: Dict[int, str] = {}
+        if base is not None:
+            if base["chunkSize"] != chunkSize:
+                raise DiskBackupWriterException(
+                    f"Chunk size [{chunkSize}] does not match parent manifest "
+                    f"chunk size [{base['chunkSize']}]"
+                )
+            self.chunks = {int(offset): digest for offset, digest in base["chunks"]}
+        self.written = 0
+        self.duplicate = 0
+        self._lock = threading.Lock()
+
+    def write(self, offset: int, data: Union[bytes, bytearray]) -> None:
+        """Store chunk for offset"""
+        if offset % self.chunkSize:
+            raise DiskBackupWriterException(f"Unaligned write at offset [{offset}]")
+        digest, written = self.store.put(data)
+        with self._lock:
+            self.chunks[offset] = digest
+            if written:
+                self.written += len(data)
+            else:
+                self.duplicate += len(data)
+
+    def close(self) -> None:
+        """Nothing to flush, chunks are written synchronously"""
+
+    def manifest(self, **info: str) -> Dict[str, Any]:
+        """Return manifest for the stored disk"""
+        return {
+            **info,
+            "size": self.size,
+            "chunkSize": self.chunkSize,
+            "chunks": sorted(self.chunks.items()),
+        }
+
+
+def chunks(chunkStore: store, manifest: Dict[str, Any]) -> Iterator[Tuple[int, bytes]]:
+    """Yield (offset, data) for all chunks referenced by manifest"""
+    for offset, digest in manifest["chunks"]:
+        yield int(offset), chunkStore.get(digest)
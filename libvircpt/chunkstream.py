@@ -0,0 +1,195 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import struct
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from libvircpt.exceptions import DiskBackupWriterException, RestoreError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger("chunkstream")
+
+# Stream file layout:
+#   MAGIC
+#   frames: FRAME header (offset, length, compressed size) + zstd data
+#   index: JSON object with disk size, list of frames, checkpoint and
+#          for incremental backups the checkpoint they are based on
+#   TRAILER (index length) + MAGIC
+MAGIC = b"VIRCPTS1"
+FRAME = struct.Struct("<QQI")
+TRAILER = struct.Struct("<Q")
+# maximum length of zeroed ranges stored in a single frame
+ZERO_FRAME = 4 * 1024 * 1024
+
+
+def _requireZstd(action: str) -> None:
+    if zstandard is None:
+        raise DiskBackupWriterException(
+            f"Python zstandard module required to {action} stream files."
+        )
+
+
+class streamWriter:
+    """Write compressed chunks into a seekable stream file. Chunks are
+    compressed by the calling copy threads in parallel, each thread
+    using its own compressor, only appending to the file is serialized."""
+
+    def __init__(
+        self,
+        fileName: str,
+        size: int,
+        level: int = 3,
+        info: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        _requireZstd("write")
+        self.fileName = fileName
+        self.level = level
+        # written into the index on close
+        self.info = {"size": size, "compression": "zstd", **(info or {})}
+        self._index: List[Tuple[int, int, int, int]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        try:
+            # pylint: disable=consider-using-with
+            self._fh = open(fileName, "wb")
+            self._fh.write(MAGIC)
+        except OSError as e:
+            raise DiskBackupWriterException(
+                f"Unable to open target file [{fileName}]: [{e}]"
+            ) from e
+
+    def _compressor(self) -> Any:
+        cctx = getattr(self._local, "cctx", None)
+        if cctx is None:
+            cctx = zstandard.ZstdCompressor(level=self.level)
+            self._local.cctx = cctx
+        return cctx
+
+    def write(self, offset: int, data: Union[bytes, bytearray]) -> None:
+        """Compress data and append frame for offset"""
+        payload = self._compressor().compress(bytes(data))
+        with self._lock:
+            pos = self._fh.tell() + FRAME.size
+            self._fh.write(FRAME.pack(offset, len(data), len(payload)))
+            self._fh.write(payload)
+            self._index.append((offset, len(data), pos, len(payload)))
+
+    def zero(self, offset: int, length: int) -> None:
+        """Record zeroed range, written as compressed frames"""
+        end = offset + length
+        while offset < end:
+            size = min(ZERO_FRAME, end - offset)
+            self.write(offset, bytes(size))
+            offset += size
+
+    def close(self) -> None:
+        """Write index and trailer"""
+        index = json.dumps(
+            {
+                **self.info,
+                "frames": sorted(self._index),
+            }
+        ).encode()
+        self._fh.write(index)
+        self._fh.write(TRAILER.pack(len(index)))
+        self._fh.write(MAGIC)
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+
+
+class streamReader:
+    """Read stream files using the index at the end of the file"""
+
+    def __init__(self, fileName: str) -> None:
+        _requireZstd("read")
+        self.fileName = fileName
+        # pylint: disable=consider-using-with
+        self._fh = open(fileName, "rb")
+        self._dctx = zstandard.ZstdDecompressor()
+        self.index = self._readIndex()
+        self.size: int = self.index["size"]
+
+    @property
+    def checkpoint(self) -> Optional[str]:
+        """Checkpoint the stream file was created from"""
+        return self.index.get("checkpoint")
+
+    @property
+    def incremental(self) -> bool:
+        """Stream file only contains the changes to base"""
+        return self.index.get("incremental", False)
+
+    @property
+    def base(self) -> Optional[str]:
+        """Checkpoint the incremental backup is based on"""
+        return self.index.get("base")
+
+    def _readIndex(self) -> Dict[str, Any]:
+        if self._fh.read(len(MAGIC)) != MAGIC:
+            raise RestoreError(f"[{self.fileName}] is not a stream file")
+        self._fh.seek(-(TRAILER.size + len(MAGIC)), os.SEEK_END)
+        (length,) = TRAILER.unpack(self._fh.read(TRAILER.size))
+        if self._fh.read(len(MAGIC)) != MAGIC:
+            raise RestoreError(f"[{self.fileName}] is incomplete: trailer missing")
+        self._fh.seek(-(TRAILER.size + len(MAGIC) + length), os.SEEK_END)
+        return json.loads(self._fh.read(length))
+
+    def extents(self) -> List[Tuple[int, int]]:
+        """Return (offset, length) of the stored chunks"""
+        return [(offset, length) for offset, length, _, _ in self.index["frames"]]
+
+    def frames(self) -> Iterator[Tuple[int, bytes]]:
+        """Yield (offset, data) for all chunks ordered by offset"""
+        for offset, length, pos, csize in self.index["frames"]:
+            self._fh.seek(pos)
+            data = self._dctx.decompress(self._fh.read(csize), max_output_size=length)
+            yield offset, data
+
+    def close(self) -> None:
+        """Close stream file"""
+        self._fh.close()
+
+
+def chain(fileNames: List[str]) -> List[streamReader]:
+    """Open stream files of a backup chain: a full backup followed by
+    incremental backups, each based on the checkpoint of the previous"""
+    readers = [streamReader(fileName) for fileName in fileNames]
+    try:
+        if readers[0].incremental:
+            raise RestoreError(
+                f"[{readers[0].fileName}] is an incremental backup based on "
+                f"checkpoint [{readers[0].base}]: pass the full backup and all "
+                "incremental backups up to this one."
+            )
+        for parent, reader in zip(readers, readers[1:]):
+            if not reader.incremental or reader.base != parent.checkpoint:
+                raise RestoreError(
+                    f"[{reader.fileName}] is not an incremental backup based on "
+                    f"[{parent.fileName}]."
+                )
+    except RestoreError:
+        for reader in readers:
+            reader.close()
+        raise
+    return readers
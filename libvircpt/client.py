@@ -15,10 +15,12 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import logging
-from dataclasses import dataclass
+import threading
+from fnmatch import fnmatch
+from dataclasses import dataclass, replace
 from socket import gethostname
 from argparse import Namespace
-from typing import Any, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 from lxml.etree import _Element
 import libvirt
 from libvircpt.exceptions import (
@@ -27,6 +29,11 @@ from libvircpt.exceptions import (
 )
 from libvircpt import xml
 from libvircpt import disktype
+from libvircpt import metrics
+
+
+# number of domain configurations whose disk list is cached
+INVENTORY_SIZE = 128
 
 
 @dataclass
@@ -38,6 +45,7 @@ class DomainDisk:
     filename: str
     path: str
     size: int
+    scratch: str = ""
 
 
 def libvirt_ignore(
@@ -54,14 +62,26 @@ libvirt.registerErrorHandler(f=libvirt_ignore, ctx=None)
 log = logging.getLogger("virt")
 
 
+def diskSize(domObj: libvirt.virDomain, disk: DomainDisk) -> int:
+    """Return size of disk as reported by libvirt, only queried if
+    not yet known"""
+    if not disk.size:
+        disk.size = domObj.blockInfo(disk.target)[0]
+    return disk.size
+
+
 class client:
     """Libvirt related functions"""
 
     def __init__(self, uri: Namespace) -> None:
         self.remoteHost: str = ""
-        self._conn = self._connect(uri)
+        with metrics.collector.phase("connect"):
+            self._conn = self._connect(uri)
         self._domObj = None
         self.libvirtVersion = self._conn.getLibVersion()
+        self._volumes: Dict[Tuple[str, str], str] = {}
+        self._inventory: Dict[Tuple, List[DomainDisk]] = {}
+        self._cacheLock = threading.Lock()
 
     @staticmethod
     def _connectAuth(uri: str, user: str, password: str) -> libvirt.virConnect:
@@ -135,6 +155,24 @@ class client:
 
         return self._connectOpen(args.uri)
 
+    def registerEvents(self, handler: Any) -> None:
+        """Register callbacks for block job and job completed events,
+        requires the libvirt event loop to be running"""
+        self._conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, handler.blockJob, None
+        )
+        self._conn.domainEventRegisterAny(
+            None,
+            libvirt.VIR_DOMAIN_EVENT_ID_JOB_COMPLETED,
+            handler.jobCompleted,
+            None,
+        )
+        self._conn.setKeepAlive(5, 3)
+
+    def close(self) -> None:
+        """Close libvirt connection"""
+        self._conn.close()
+
     def getDomain(self, name: str) -> libvirt.virDomain:
         """Lookup domain"""
         try:
@@ -142,25 +180,73 @@ class client:
         except libvirt.libvirtError as e:
             raise domainNotFound(e) from e
 
+    def _listDomains(self, running: bool) -> List[str]:
+        flags = 0
+        if running:
+            flags = libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE
+        try:
+            return sorted(dom.name() for dom in self._conn.listAllDomains(flags))
+        except libvirt.libvirtError as e:
+            raise domainNotFound(e) from e
+
+    def _lookupName(self, name: str, running: bool) -> str:
+        domObj = self.getDomain(name)
+        if running and not domObj.isActive():
+            raise domainNotFound(f"No domain matching [{name}] found.")
+        return domObj.name()
+
+    def getDomains(self, patterns: List[str], running: bool = False) -> List[str]:
+        """Return names of domains matching the passed names or
+        glob patterns, or all running domains. Plain names are looked up
+        directly, domains are only listed for glob patterns: a name
+        matching an existing domain is never treated as pattern."""
+        if running and not patterns:
+            return self._listDomains(running)
+
+        names: Optional[List[str]] = None
+        domains: List[str] = []
+        for pattern in patterns:
+            if not any(char in pattern for char in "*?["):
+                matches = [self._lookupName(pattern, running)]
+            else:
+                if names is None:
+                    names = self._listDomains(running)
+                if pattern in names:
+                    matches = [pattern]
+                else:
+                    matches = [name for name in names if fnmatch(name, pattern)]
+            if not matches:
+                raise domainNotFound(f"No domain matching [{pattern}] found.")
+            domains += [name for name in matches if name not in domains]
+
+        return domains
+
     @staticmethod
     def getDomainConfig(domObj: libvirt.virDomain) -> str:
         """Return Virtual Machine configuration as XML"""
-        return domObj.XMLDesc(0)
+        with metrics.collector.phase("getDomainConfig"):
+            return domObj.XMLDesc(0)
 
-    def _getDiskPathByVolume(self, disk: _Element) -> Union[str, None]:
+    def _getDiskPathByVolume(self, source: _Element) -> Union[str, None]:
         """If virtual machine disk is configured via type='volume'
         get path to disk via appropriate libvirt functions,
-        pool and volume setting are mandatory as by xml schema definition"""
-        vol = disk.xpath("source")[0].get("volume")
-        pool = disk.xpath("source")[0].get("pool")
+        pool and volume setting are mandatory as by xml schema definition.
+        Lookups are cached for the lifetime of the connection."""
+        key = (source.get("pool"), source.get("volume"))
+        with self._cacheLock:
+            diskPath = self._volumes.get(key)
+        if diskPath is not None:
+            return diskPath
 
         try:
-            diskPool = self._conn.storagePoolLookupByName(pool)
-            diskPath = diskPool.storageVolLookupByName(vol).path()
+            diskPool = self._conn.storagePoolLookupByName(key[0])
+            diskPath = diskPool.storageVolLookupByName(key[1]).path()
         except libvirt.libvirtError as errmsg:
             log.error("Failed to detect vm disk by volumes: [%s]", errmsg)
             return None
 
+        with self._cacheLock:
+            self._volumes[key] = diskPath
         return diskPath
 
     def getDomainDisksFromCheckpoint(self, cptConfig: str) -> List[DomainDisk]:
@@ -178,8 +264,25 @@ class client:
 
     def getDomainDisks(self, args: Namespace, vmConfig: str) -> List[DomainDisk]:
         """Parse virtual machine configuration for disk devices, filter
-        all non supported devices
+        all non supported devices. The result is cached until the
+        configuration changes, callers get their own copy.
         """
+        key = (vmConfig, args.exclude, args.include, getattr(args, "raw", False))
+        with self._cacheLock:
+            cached = self._inventory.get(key)
+        if cached is not None:
+            log.debug("Using cached device list.")
+            return [replace(disk) for disk in cached]
+
+        devices = self._parseDomainDisks(args, vmConfig)
+        with self._cacheLock:
+            if len(self._inventory) >= INVENTORY_SIZE:
+                del self._inventory[next(iter(self._inventory))]
+            self._inventory[key] = [replace(disk) for disk in devices]
+        return devices
+
+    def _parseDomainDisks(self, args: Namespace, vmConfig: str) -> List[DomainDisk]:
+        """Collect disk devices in a single pass over the configuration"""
         tree = xml.asTree(vmConfig)
         devices = []
 
@@ -187,10 +290,13 @@ class client:
         if args.exclude is not None:
             excludeList = args.exclude.split(",")
 
-        for disk in tree.xpath("devices/disk"):
-            dev = disk.xpath("target")[0].get("dev")
+        for disk in tree.iterfind("devices/disk"):
+            elements = {child.tag: child for child in disk}
+            target = elements["target"]
+            source = elements.get("source")
+            dev = target.get("dev")
             device = disk.get("device")
-            diskFormat = disk.xpath("driver")[0].get("type")
+            diskFormat = elements["driver"].get("type")
 
             if excludeList is not None and dev in excludeList:
                 log.warning("Excluding disk [%s] from operation as requested", dev)
@@ -200,7 +306,7 @@ class client:
             # creating checkpoints
             if (
                 disktype.Optical(device, dev)
-                or disktype.Block(disk, dev)
+                or disktype.Block(target, dev)
                 or disktype.Lun(device, dev)
                 or disktype.Raw(diskFormat, dev)
             ):
@@ -208,20 +314,23 @@ class client:
 
             diskPath = None
             diskType = disk.get("type")
+            if source is None:
+                log.error("Unable to detect disk source for disk [%s]", dev)
+                continue
             if diskType == "volume":
                 log.debug("Disk [%s]: volume notation", dev)
-                diskPath = self._getDiskPathByVolume(disk)
+                diskPath = self._getDiskPathByVolume(source)
             elif diskType == "file":
                 log.debug("Disk [%s]: file notation", dev)
-                diskPath = disk.xpath("source")[0].get("file")
+                diskPath = source.get("file")
             elif diskType == "block":
-                if args.raw is False:
+                if not getattr(args, "raw", False):
                     log.warning(
                         "Skipping direct attached block device [%s], use option --raw to include.",
                         dev,
                     )
                     continue
-                diskPath = disk.xpath("source")[0].get("dev")
+                diskPath = source.get("dev")
             else:
                 log.error("Unable to detect disk volume type for disk [%s]", dev)
                 continue
@@ -249,7 +358,8 @@ class client:
     def stopExport(domObj: libvirt.virDomain) -> bool:
         """Cancel the export task using job abort"""
         try:
-            domObj.abortJob()
+            with metrics.collector.phase("abortJob"):
+                domObj.abortJob()
             return True
         except libvirt.libvirtError as err:
             log.warning("Failed to stop block job: [%s]", err)
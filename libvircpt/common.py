@@ -17,8 +17,12 @@
 import sys
 import logging
 import logging.handlers
+import importlib
+import contextvars
+from types import ModuleType
 from argparse import Namespace
-from typing import List, Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, List, Any, Optional
 from libvircpt.logcount import logCount
 
 log = logging.getLogger("lib")
@@ -27,6 +31,22 @@ logFormat = "%(asctime)s %(levelname)s %(name)s %(module)s - %(funcName)s: %(mes
 logDateFormat = "[%Y-%m-%d %H:%M:%S]"
 
 
+class lazyModule(ModuleType):
+    """Module imported on first attribute access, used to load heavy
+    modules only if the subcommand executed needs them"""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attr: str) -> Any:
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_module"] = module
+        return getattr(module, attr)
+
+
 def argparse(parser) -> Namespace:
     """Parse arguments"""
     return parser.parse_args()
@@ -37,6 +57,13 @@ def printVersion(version) -> None:
     log.info("Version: %s Arguments: %s", version, " ".join(sys.argv))
 
 
+def splitList(value: Optional[str]) -> List[str]:
+    """Split comma separated option value"""
+    if value is None:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
 def setLogLevel(verbose: bool) -> int:
     """Set loglevel"""
     level = logging.INFO
@@ -56,3 +83,24 @@ def configLogger(args: Namespace, counter: logCount):
         datefmt=logDateFormat,
         handlers=handler,
     )
+
+
+def runParallel(func: Callable, items: Iterable[Any], jobs: int = 1) -> None:
+    """Run func for each item using a bounded pool of worker threads.
+    Failures are logged per item and do not stop processing the other
+    items, the logCount handler accounts them for the exit status.
+    The callers context is passed to the threads, so log messages are
+    accounted for the domain currently processed."""
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, func, item): item
+            for item in items
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                item = futures[future]
+                log.error(
+                    "Processing [%s] failed: [%s]", getattr(item, "target", item), e
+                )
@@ -41,9 +41,9 @@ def Lun(device: list, dev: str) -> bool:
     return False
 
 
-def Block(disk: _Element, dev: str) -> bool:
+def Block(target: _Element, dev: str) -> bool:
     """Check if device is direct attached block type device"""
-    if disk.xpath("target")[0].get("type") == "block":
+    if target.get("type") == "block":
         log.warning(
             "Excluding unsupported block device [%s].",
             dev,
@@ -55,3 +55,19 @@ class UntilCheckpointReached(RestoreException):
 
 class RestoreError(RestoreException):
     """Base restore error Exception"""
+
+
+class NbdException(Exception):
+    """Base NBD Exception"""
+
+
+class NbdConnectionError(NbdException):
+    """Can't connect NBD export"""
+
+
+class ScratchSpaceError(BackupException):
+    """Not enough free space for scratch files"""
+
+
+class StateFileError(Exception):
+    """State directory or file is not trusted"""
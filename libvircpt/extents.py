@@ -0,0 +1,237 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import heapq
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, List, Tuple
+import nbd
+
+log = logging.getLogger("extents")
+
+# flags reported by the qemu NBD server for the different
+# meta contexts
+STATE_HOLE = nbd.STATE_HOLE
+STATE_ZERO = nbd.STATE_ZERO
+STATE_DIRTY = 1
+
+BITMAP_PREFIX = "qemu:dirty-bitmap:"
+BASE_ALLOCATION = "base:allocation"
+
+# maximum range queried with one block status request
+MAX_REQUEST = 2**30
+
+
+def query(handle: nbd.NBD, metaContext: str) -> Iterator[Tuple[int, int, int]]:
+    """Query block status for the complete export and yield
+    extents as (offset, length, flags) as they are returned by
+    the server"""
+    size = handle.get_size()
+    offset = 0
+    while offset < size:
+        reply: List[Tuple[int, int]] = []
+        handle.block_status(
+            min(size - offset, MAX_REQUEST), offset, collect(metaContext, reply)
+        )
+        if not reply:
+            break
+        for extent in clip(reply, offset, size):
+            yield extent
+            offset = extent[0] + extent[1]
+
+
+def collect(metaContext: str, reply: List[Tuple[int, int]]) -> Callable:
+    """Return block status callback appending (length, flags) of the
+    extents reported for metaContext to reply"""
+
+    def _cb(context: str, _offset: int, entries: List[int], _err) -> int:
+        if context != metaContext:
+            return 0
+        for i in range(0, len(entries), 2):
+            reply.append((entries[i], entries[i + 1]))
+        return 0
+
+    return _cb
+
+
+def clip(
+    reply: List[Tuple[int, int]], offset: int, size: int
+) -> Iterator[Tuple[int, int, int]]:
+    """Yield (offset, length, flags) for block status reply starting
+    at offset, extents exceeding the export size are truncated"""
+    for length, flags in reply:
+        length = min(length, size - offset)
+        yield offset, length, flags
+        offset += length
+        if offset >= size:
+            break
+
+
+def ranges(
+    extents: Iterator[Tuple[int, int, int]], mask: int, match: bool = True
+) -> Iterator[Tuple[int, int]]:
+    """Yield (offset, length) of extents where flags match mask,
+    adjacent extents are merged into a single range"""
+    start = None
+    end = 0
+    for offset, length, flags in extents:
+        if bool(flags & mask) is match:
+            if start is None:
+                start = offset
+            elif offset != end:
+                yield start, end - start
+                start = offset
+            end = offset + length
+    if start is not None:
+        yield start, end - start
+
+
+def union(*rangeLists: Iterator[Tuple[int, int]]) -> Iterator[Tuple[int, int]]:
+    """Yield union of range lists each sorted by offset, as needed if
+    the dirty extents of multiple bitmaps are combined. Lists are merged
+    in a single pass, overlapping or adjacent ranges are joined."""
+    start = None
+    end = 0
+    for offset, length in heapq.merge(*rangeLists):
+        if start is not None and offset <= end:
+            end = max(end, offset + length)
+            continue
+        if start is not None:
+            yield start, end - start
+        start = offset
+        end = offset + length
+    if start is not None:
+        yield start, end - start
+
+
+def _append(rangeList: List[Tuple[int, int]], offset: int, length: int) -> None:
+    if rangeList and rangeList[-1][0] + rangeList[-1][1] == offset:
+        rangeList[-1] = (rangeList[-1][0], rangeList[-1][1] + length)
+    else:
+        rangeList.append((offset, length))
+
+
+def split(
+    rangeList: List[Tuple[int, int]], extents: Iterator[Tuple[int, int, int]]
+) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """Split sorted ranges into data and zero ranges using the extents
+    reported for base:allocation. Parts not covered by the reported
+    extents are considered data."""
+    data: List[Tuple[int, int]] = []
+    zero: List[Tuple[int, int]] = []
+    pending = iter(rangeList)
+    current = next(pending, None)
+    for offset, length, flags in extents:
+        end = offset + length
+        target = zero if flags & STATE_ZERO else data
+        while current is not None:
+            start, size = current
+            if start >= end:
+                break
+            if start < offset:
+                _append(data, start, min(offset, start + size) - start)
+                size -= min(offset, start + size) - start
+                start = offset
+            if size > 0:
+                _append(target, start, min(end, start + size) - start)
+            if start + size <= end:
+                current = next(pending, None)
+                continue
+            current = (end, start + size - end)
+            break
+        if current is None:
+            break
+    while current is not None:
+        _append(data, *current)
+        current = next(pending, None)
+    return data, zero
+
+
+def dirty(handle: nbd.NBD, bitmap: str) -> List[Tuple[int, int]]:
+    """Return ranges marked dirty in bitmap"""
+    return list(ranges(query(handle, f"{BITMAP_PREFIX}{bitmap}"), STATE_DIRTY))
+
+
+def describe(metaContext: str, flags: int) -> str:
+    """Return description for extent flags as used by nbdinfo"""
+    if metaContext.startswith(BITMAP_PREFIX):
+        return "dirty" if flags & STATE_DIRTY else "clean"
+
+    desc = []
+    if flags & STATE_HOLE:
+        desc.append("hole")
+    if flags & STATE_ZERO:
+        desc.append("zero")
+    return ",".join(desc) or "data"
+
+
+def selectMask(metaContext: str) -> Tuple[int, bool]:
+    """Return flag mask and match value selecting the extents of
+    interest: dirty extents for bitmaps, allocated extents otherwise"""
+    if metaContext.startswith(BITMAP_PREFIX):
+        return STATE_DIRTY, True
+    return STATE_HOLE, False
+
+
+@dataclass
+class extentSummary:
+    """Summary about extents of interest within an export"""
+
+    bytes: int = 0
+    count: int = 0
+    largest: List[Tuple[int, int]] = field(default_factory=list)
+
+    def add(self, offset: int, length: int, top: int) -> None:
+        """Account extent and keep track of the largest runs"""
+        self.bytes += length
+        self.count += 1
+        if len(self.largest) < top:
+            heapq.heappush(self.largest, (length, offset))
+        elif top > 0:
+            heapq.heappushpop(self.largest, (length, offset))
+
+    def top(self) -> List[Tuple[int, int]]:
+        """Return largest runs as (offset, length) sorted by size"""
+        return [(o, l) for l, o in sorted(self.largest, reverse=True)]
+
+
+def summarize(
+    extents: Iterator[Tuple[int, int, int]], metaContext: str, top: int = 5
+) -> extentSummary:
+    """Build summary while consuming the extents, without keeping
+    the complete extent list in memory"""
+    summary = extentSummary()
+    flagMask, match = selectMask(metaContext)
+    for offset, length in ranges(extents, flagMask, match):
+        summary.add(offset, length, top)
+    return summary
+
+
+def align(
+    rangeList: List[Tuple[int, int]], blockSize: int, size: int
+) -> List[Tuple[int, int]]:
+    """Expand ranges to blockSize boundaries and merge overlapping
+    ranges, required for targets operating on fixed size chunks"""
+    result: List[Tuple[int, int]] = []
+    for offset, length in sorted(rangeList):
+        start = offset - offset % blockSize
+        end = min(-(-(offset + length) // blockSize) * blockSize, size)
+        if result and start <= result[-1][0] + result[-1][1]:
+            prevStart, prevLength = result[-1]
+            result[-1] = (prevStart, max(prevStart + prevLength, end) - prevStart)
+        else:
+            result.append((start, end - start))
+    return result
@@ -14,8 +14,12 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import time
 import logging
+import threading
+from typing import Optional
 import libvirt
+from libvircpt import metrics
 
 log = logging.getLogger("fs")
 
@@ -42,3 +46,56 @@ def thaw(domObj: libvirt.virDomain) -> bool:
     except libvirt.libvirtError as errmsg:
         log.warning(errmsg)
         return False
+
+
+class freezeWindow:
+    """Freeze filesystems for the duration of the with block and
+    thaw them exactly once on exit. If a deadline is set and exceeded,
+    filesystems are thawed right away and expired is set, so the
+    caller can abort the operation. The freeze duration is kept in
+    duration."""
+
+    def __init__(self, domObj: libvirt.virDomain, deadline: float = 0) -> None:
+        self.domObj = domObj
+        self.deadline = deadline
+        self.expired = False
+        self.duration = 0.0
+        self._start: Optional[float] = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def frozen(self) -> bool:
+        """Filesystems are currently frozen"""
+        return self._start is not None
+
+    def _thaw(self) -> None:
+        with self._lock:
+            if self._start is None:
+                return
+            self.duration = time.monotonic() - self._start
+            self._start = None
+        thaw(self.domObj)
+
+    def _expire(self) -> None:
+        log.error("Freeze deadline of [%s] seconds exceeded, thawing.", self.deadline)
+        self.expired = True
+        self._thaw()
+
+    def __enter__(self) -> "freezeWindow":
+        if not freeze(self.domObj):
+            return self
+        self._start = time.monotonic()
+        if self.deadline > 0:
+            self._timer = threading.Timer(self.deadline, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._thaw()
+        if self.duration:
+            log.info("Filesystems were frozen for [%.3f] seconds.", self.duration)
+            metrics.collector.observe("freeze", self.duration)
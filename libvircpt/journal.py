@@ -0,0 +1,121 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Tuple
+from libvircpt import extents
+
+log = logging.getLogger("journal")
+
+# seconds between journal updates while copy is running
+INTERVAL = 5.0
+
+
+def merge(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Sort ranges and join overlapping or adjacent ones"""
+    return list(extents.union(sorted(ranges)))
+
+
+def subtract(
+    ranges: List[Tuple[int, int]], done: List[Tuple[int, int]]
+) -> List[Tuple[int, int]]:
+    """Return parts of ranges not covered by done"""
+    done = merge(done)
+    result: List[Tuple[int, int]] = []
+    for offset, length in ranges:
+        end = offset + length
+        for doneOffset, doneLength in done:
+            doneEnd = doneOffset + doneLength
+            if doneEnd <= offset or doneOffset >= end:
+                continue
+            if doneOffset > offset:
+                result.append((offset, doneOffset - offset))
+            offset = max(offset, doneEnd)
+            if offset >= end:
+                break
+        if offset < end:
+            result.append((offset, end - offset))
+    return result
+
+
+class journal:
+    """Record extents successfully copied into the target image, so an
+    interrupted copy can be resumed. The journal is only valid for the
+    export it has been written for: identity holds the attributes
+    of the export and target which must not change."""
+
+    def __init__(self, fileName: str, identity: Dict[str, Any]) -> None:
+        self.file = f"{fileName}.journal"
+        self.identity = identity
+        self.done: List[Tuple[int, int]] = []
+        self._saved = time.monotonic()
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Load completed extents, returns true if the journal
+        matches current export and the copy can be resumed"""
+        try:
+            with open(self.file, "r", encoding="utf-8") as fh:
+                state = json.load(fh)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            log.warning("Ignoring invalid journal [%s]: [%s]", self.file, e)
+            return False
+
+        if state.get("identity") != self.identity:
+            log.info("Journal [%s] is outdated: export has changed.", self.file)
+            return False
+
+        self.done = [(extent[0], extent[1]) for extent in state["done"]]
+        return True
+
+    def record(self, offset: int, length: int) -> None:
+        """Mark extent as copied, called from multiple threads.
+        The journal is written if the last update is older than
+        INTERVAL seconds."""
+        with self._lock:
+            self.done.append((offset, length))
+            if time.monotonic() - self._saved < INTERVAL:
+                return
+            self._save()
+
+    def save(self) -> None:
+        """Write journal"""
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        self.done = merge(self.done)
+        tmpFile = f"{self.file}.tmp"
+        try:
+            with open(tmpFile, "w", encoding="utf-8") as fh:
+                json.dump({"identity": self.identity, "done": self.done}, fh)
+            os.replace(tmpFile, self.file)
+        except OSError as e:
+            log.warning("Unable to write journal [%s]: [%s]", self.file, e)
+        self._saved = time.monotonic()
+
+    def remove(self) -> None:
+        """Remove journal after copy has been completed"""
+        try:
+            os.unlink(self.file)
+        except FileNotFoundError:
+            pass
@@ -16,10 +16,19 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import logging
+import contextvars
+from collections import defaultdict
+
+# domain currently processed, used to account log messages
+# per domain in batch mode
+currentDomain: contextvars.ContextVar = contextvars.ContextVar(
+    "currentDomain", default=None
+)
 
 
 class logCount(logging.Handler):
-    """Custom log handler keeping track of issued log messages"""
+    """Custom log handler keeping track of issued log messages,
+    overall and per processed domain"""
 
     class LogType:
         """Log message type"""
@@ -31,9 +40,15 @@ class logCount(logging.Handler):
     def __init__(self) -> None:
         super().__init__()
         self.count = self.LogType()
+        self.domains: defaultdict = defaultdict(self.LogType)
 
     def emit(self, record: logging.LogRecord) -> None:
-        if record.levelname == "WARNING":
-            self.count.warnings += 1
-        if record.levelname in ("ERROR", "FATAL", "CRITICAL"):
-            self.count.errors += 1
+        counts = [self.count]
+        domain = currentDomain.get()
+        if domain is not None:
+            counts.append(self.domains[domain])
+        for count in counts:
+            if record.levelname == "WARNING":
+                count.warnings += 1
+            if record.levelname in ("ERROR", "FATAL", "CRITICAL"):
+                count.errors += 1
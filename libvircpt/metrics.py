@@ -0,0 +1,147 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+from libvircpt.logcount import currentDomain
+
+log = logging.getLogger("metrics")
+
+PREFIX = "vircpt"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class metrics:
+    """Collect phase timings and counters of a run. Values are
+    labeled with the domain currently processed, so concurrent
+    operations on multiple domains are accounted separately."""
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.phases: Dict[Tuple[str, Labels], List[float]] = {}
+        self.counters: Dict[Tuple[str, Labels], int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> Labels:
+        domain = currentDomain.get()
+        if domain is not None:
+            labels = {"domain": domain, **labels}
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """Record duration of phase"""
+        key = (name, self._labels(labels))
+        with self._lock:
+            entry = self.phases.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add(self, name: str, value: int, **labels: str) -> None:
+        """Increase counter"""
+        key = (name, self._labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def phase(self, name: str, **labels: str) -> Iterator[None]:
+        """Time the with block, failed attempts are accounted too"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def asDict(self) -> Dict:
+        """Return collected metrics"""
+        with self._lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "phases": [
+                    {"phase": name, **dict(labels), "count": count, "seconds": seconds}
+                    for (name, labels), (count, seconds) in sorted(self.phases.items())
+                ],
+                "counters": [
+                    {"name": name, **dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+
+    def prometheus(self) -> str:
+        """Return collected metrics in prometheus text format"""
+
+        def _fmt(labels: Labels) -> str:
+            if not labels:
+                return ""
+            values = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+            return f"{{{values}}}"
+
+        result = self.asDict()
+        lines = [
+            f"# HELP {PREFIX}_run_started_seconds Start time of run.",
+            f"# TYPE {PREFIX}_run_started_seconds gauge",
+            f"{PREFIX}_run_started_seconds {result['started']:.3f}",
+            f"# HELP {PREFIX}_run_duration_seconds Duration of run.",
+            f"# TYPE {PREFIX}_run_duration_seconds gauge",
+            f"{PREFIX}_run_duration_seconds {result['duration']:.6f}",
+            f"# HELP {PREFIX}_phase_duration_seconds Time spent per phase.",
+            f"# TYPE {PREFIX}_phase_duration_seconds gauge",
+        ]
+        with self._lock:
+            phases = sorted(self.phases.items())
+            counters = sorted(self.counters.items())
+        for (name, labels), (_, seconds) in phases:
+            lines.append(
+                f"{PREFIX}_phase_duration_seconds"
+                f"{_fmt(labels + (('phase', name),))} {seconds:.6f}"
+            )
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.append(f"{PREFIX}_{name}_total{_fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, fileName: str, fmt: str = "json") -> None:
+        """Write metrics atomically, as required for the textfile
+        collector of the prometheus node exporter"""
+        if fmt == "prometheus":
+            data = self.prometheus()
+        else:
+            data = json.dumps(self.asDict(), indent=2)
+        tmpFile = f"{fileName}.tmp"
+        try:
+            with open(tmpFile, "w", encoding="utf-8") as fh:
+                fh.write(data)
+            os.replace(tmpFile, fileName)
+        except OSError as e:
+            log.error("Unable to write metrics to [%s]: [%s]", fileName, e)
+
+
+# metrics of the current run
+collector = metrics()
@@ -0,0 +1,139 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import signal
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+from subprocess import CalledProcessError
+from typing import Iterator, List, Optional, Tuple
+import nbd
+from libvircpt import command
+from libvircpt.exceptions import NbdConnectionError
+
+log = logging.getLogger("nbd")
+
+# seconds to wait for qemu-nbd to close the image
+STOP_TIMEOUT = 30
+
+
+def uri(server: str, exportName: str = "") -> str:
+    """Return NBD URI for export, server is either the path to the
+    libvirt unix socket or the URI of a TCP export without export name"""
+    if "://" not in server:
+        return f"nbd+unix:///{exportName}?socket={server}"
+
+    base, sep, query = server.partition("?")
+    pathStart = base.find("/", base.index("://") + 3)
+    if pathStart != -1:
+        base = base[:pathStart]
+    return f"{base}/{exportName}{sep}{query}"
+
+
+def tls(server: str) -> bool:
+    """Check if server is the URI of a TLS export, qemu does not
+    accept nbds URIs: these exports are usable via libnbd only"""
+    return server.startswith("nbds://")
+
+
+def connect(nbdUri: str, metaContexts: Optional[List[str]] = None) -> nbd.NBD:
+    """Open connection to NBD export, optionally requesting
+    meta contexts for block status queries"""
+    log.debug("Connecting NBD export: [%s]", nbdUri)
+    handle = nbd.NBD()
+    try:
+        for context in metaContexts or []:
+            handle.add_meta_context(context)
+        handle.connect_uri(nbdUri)
+    except nbd.Error as e:
+        raise NbdConnectionError(f"Unable to connect [{nbdUri}]: [{e}]") from e
+
+    return handle
+
+
+def disconnect(handle: nbd.NBD) -> None:
+    """Close NBD connection"""
+    try:
+        handle.shutdown()
+    except nbd.Error as e:
+        log.debug("Error during NBD shutdown: [%s]", e)
+
+
+def startServer(
+    fileName: str, imageFormat: str, connections: int, options: List[str]
+) -> Tuple[str, str]:
+    """Start qemu-nbd exporting image on a temporary unix socket accepting
+    multiple connections (0 for unlimited), returns the temporary
+    directory holding socket and pid file and the NBD URI"""
+    tmpDir = tempfile.mkdtemp(prefix="vircpt.")
+    socketFile = os.path.join(tmpDir, "nbd.sock")
+    cmdLine = [
+        "qemu-nbd",
+        "-t",
+        "-f",
+        imageFormat,
+        f"--shared={connections}",
+        "--fork",
+        f"--pid-file={os.path.join(tmpDir, 'nbd.pid')}",
+        "-k",
+        socketFile,
+    ]
+    try:
+        command.run(cmdLine + options + [fileName])
+    except (CalledProcessError, FileNotFoundError) as e:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        stderr = getattr(e, "stderr", e)
+        raise NbdConnectionError(f"Unable to export [{fileName}]: [{stderr}]") from e
+    return tmpDir, uri(socketFile)
+
+
+def stopServer(tmpDir: str, fileName: str) -> None:
+    """Stop qemu-nbd started via startServer and wait until it has
+    closed the image"""
+    try:
+        with open(os.path.join(tmpDir, "nbd.pid"), "r", encoding="utf-8") as fh:
+            pid = int(fh.read().strip())
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while time.monotonic() < deadline:
+            os.kill(pid, 0)
+            time.sleep(0.05)
+        log.warning("qemu-nbd for [%s] did not exit in time.", fileName)
+    except ProcessLookupError:
+        pass
+    except (OSError, ValueError) as e:
+        log.warning("Unable to stop qemu-nbd for [%s]: [%s]", fileName, e)
+    shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+@contextmanager
+def serveImage(
+    fileName: str, imageFormat: str, connections: int, bitmap: Optional[str] = None
+) -> Iterator[str]:
+    """Export image read only via qemu-nbd on a temporary unix socket
+    accepting multiple connections, yield the NBD URI. If bitmap is
+    set, the persistent bitmap is exported as dirty bitmap context."""
+    options = ["-r"]
+    if bitmap:
+        options += ["-B", bitmap]
+    tmpDir, nbdUri = startServer(fileName, imageFormat, connections, options)
+    try:
+        yield nbdUri
+    finally:
+        stopServer(tmpDir, fileName)
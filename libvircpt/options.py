@@ -0,0 +1,435 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from getpass import getuser
+from libvircpt import chunkstore
+
+
+def addConnectionOptions(parser) -> None:
+    """Add options for commands reading data from exports"""
+    parser.add_argument(
+        "--connections",
+        default=4,
+        type=int,
+        help="Number of NBD connections per disk. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--requests",
+        default=8,
+        type=int,
+        help="Number of requests in flight per connection. (default: %(default)s)",
+    )
+
+
+def addCopyOptions(parser, incremental: bool = True) -> None:
+    """Add options shared by the commands copying data from exports"""
+    addConnectionOptions(parser)
+    parser.add_argument(
+        "--max-rate",
+        default=0,
+        type=int,
+        help="Limit copy rate in MiB/s, 0 means unlimited. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="Reduce copy rate if guest I/O latency or IOPS rise.",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--max-latency",
+        default=10,
+        type=float,
+        help="Guest I/O latency in ms above which the copy rate is reduced "
+        "in adaptive mode. (default: %(default)s)",
+    )
+    if not incremental:
+        return
+    parser.add_argument(
+        "--incremental",
+        help="Copy only extents marked dirty since the parent checkpoint.",
+        action="store_true",
+        required=False,
+    )
+
+
+def addRetentionOptions(parser) -> None:
+    """Add options for the checkpoint retention policy"""
+    parser.add_argument(
+        "--keep",
+        default=0,
+        type=int,
+        help="Remove checkpoints except the last N. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-age",
+        default=0,
+        type=float,
+        help="Remove checkpoints older than N hours, combined with --keep "
+        "checkpoints matching either option are kept. (default: %(default)s)",
+    )
+
+
+def addGeneralOptions(parser) -> None:
+    """Options shared by all subcommands"""
+    opt = parser.add_argument_group("General options")
+    opt.add_argument(
+        "-d",
+        "--domain",
+        default=None,
+        type=str,
+        help="Domain(s) to operate on, accepts glob patterns (-d vm1,web*)",
+    )
+    opt.add_argument(
+        "--all-running",
+        default=False,
+        action="store_true",
+        help="Operate on all running domains",
+    )
+    opt.add_argument(
+        "-c",
+        "--concurrency",
+        default=1,
+        type=int,
+        help="Number of domains to process concurrently. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--report",
+        default=None,
+        type=str,
+        help="Write combined result for multiple domains as JSON to file.",
+    )
+    opt.add_argument(
+        "--metrics",
+        default=None,
+        type=str,
+        help="Write phase timings, bytes and extents of the run to file.",
+    )
+    opt.add_argument(
+        "--metrics-format",
+        default="json",
+        choices=["json", "prometheus"],
+        help="Metrics file format, prometheus writes a file for the node "
+        "exporter textfile collector. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Debug log",
+    )
+
+    user = getuser() or None
+
+    session = "qemu:///system"
+    if user != "root":
+        session = "qemu:///session"
+    opt.add_argument(
+        "-U",
+        "--uri",
+        default=session,
+        required=False,
+        type=str,
+        help="Libvirt connection URI. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--user",
+        default=None,
+        required=False,
+        type=str,
+        help="User to authenticate against libvirtd. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--password",
+        default=None,
+        required=False,
+        type=str,
+        help="Password to authenticate against libvirtd. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "-x",
+        "--exclude",
+        default=None,
+        type=str,
+        help="Exclude disk(s) with target dev name (-x vda,vdb)",
+    )
+    opt.add_argument(
+        "-i",
+        "--include",
+        default=None,
+        type=str,
+        help="Include only disk with target dev name (-i vda)",
+    )
+    opt.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of disks to process concurrently. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--freeze-deadline",
+        default=0,
+        type=float,
+        help="Maximum time in seconds filesystems are kept frozen, operation "
+        "is aborted if exceeded. 0 means no limit. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "-S",
+        "--scratchdir",
+        default="/var/tmp",
+        required=False,
+        type=str,
+        help="Target dir(s) for temporary scratch files, multiple directories "
+        "are separated by comma. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--scratch-balance",
+        default="free",
+        choices=["free", "roundrobin"],
+        type=str,
+        help="Distribute scratch files to directory with most free space "
+        "or round robin. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--scratch-reserve",
+        default=False,
+        action="store_true",
+        help="Place scratch files only in directories having enough free space "
+        "for the complete disk.",
+    )
+    opt.add_argument(
+        "--scratch-preallocate",
+        default=False,
+        action="store_true",
+        help="Create scratch files with space for the complete disk allocated "
+        "instead of letting libvirt create them.",
+    )
+    opt.add_argument(
+        "--statedir",
+        default="/run/vircpt",
+        required=False,
+        type=str,
+        help="Directory for the state file, created with mode 0700 and must be "
+        "owned by the current user. (default: %(default)s)",
+    )
+    opt.add_argument(
+        "--socketdir",
+        default="/var/tmp",
+        required=False,
+        type=str,
+        help="Directory for export sockets. (default: %(default)s)",
+    )
+
+
+def addCommands(parser) -> None:
+    """Add subcommands and their options"""
+    sub_parsers = parser.add_subparsers(help="sub-command help", dest="command")
+    parser_create = sub_parsers.add_parser("create", help="Create checkpoint")
+    parser_create.add_argument(
+        "--name", type=str, help="Name of the checkpoint", required=True
+    )
+    addRetentionOptions(parser_create)
+    parser_delete = sub_parsers.add_parser("delete", help="Delete checkpoint")
+    parser_delete.add_argument("--name", type=str, help="Name of the checkpoint")
+    addRetentionOptions(parser_delete)
+    parser_delete.add_argument(
+        "--metadata",
+        help="Delete checkpoint metadata only",
+        action="store_true",
+        required=False,
+    )
+    parser_list = sub_parsers.add_parser("list", help="List checkpoints")
+    parser_list.add_argument(
+        "--json",
+        help="Print checkpoint list as JSON.",
+        action="store_true",
+        required=False,
+    )
+    parser_export = sub_parsers.add_parser("export", help="Export checkpoints via NBD")
+    parser_export.add_argument(
+        "--name", type=str, help="Name of the checkpoint", required=True
+    )
+    parser_export.add_argument(
+        "--showinfo", help="Show NBD export info too.", action="store_true"
+    )
+    parser_export.add_argument(
+        "--since",
+        type=str,
+        default=None,
+        help="Export changes since this older checkpoint instead of "
+        "the parent checkpoint.",
+    )
+    parser_export.add_argument(
+        "--transport",
+        default="unix",
+        choices=["unix", "tcp"],
+        help="Export via local unix socket or TCP. (default: %(default)s)",
+    )
+    parser_export.add_argument(
+        "--listen-address",
+        default="127.0.0.1",
+        type=str,
+        help="Address the TCP export is bound to. (default: %(default)s)",
+    )
+    parser_export.add_argument(
+        "--port-range",
+        default="10809-10899",
+        type=str,
+        help="Ports the TCP export may use. (default: %(default)s)",
+    )
+    parser_export.add_argument(
+        "--tls",
+        default=False,
+        action="store_true",
+        help="Require TLS for the TCP export, libvirt must be configured "
+        "with backup_tls_x509_cert_dir.",
+    )
+    parser_export.add_argument(
+        "--tls-certificates",
+        default=None,
+        type=str,
+        help="Directory with client certificates used to connect the TLS export.",
+    )
+    sub_parsers.add_parser("nbdinfo", help="Show Export info")
+    parser_nbdcopy = sub_parsers.add_parser(
+        "nbdcopy", help="Copy data from NBD export to image files"
+    )
+    parser_nbdcopy.add_argument(
+        "--format",
+        default="qcow2",
+        choices=["qcow2", "raw", "stream"],
+        type=str,
+        help="Target image format, stream writes zstd compressed chunks. "
+        "(default: %(default)s)",
+    )
+    parser_nbdcopy.add_argument(
+        "--compress-level",
+        default=3,
+        type=int,
+        help="Compression level for stream format. (default: %(default)s)",
+    )
+    addCopyOptions(parser_nbdcopy)
+    parser_nbdstore = sub_parsers.add_parser(
+        "nbdstore", help="Copy data from NBD export to deduplicating chunk store"
+    )
+    parser_nbdstore.add_argument(
+        "--store", type=str, help="Path to chunk store", required=True
+    )
+    parser_nbdstore.add_argument(
+        "--chunk-size",
+        default=chunkstore.CHUNK_SIZE,
+        type=int,
+        help="Chunk size in bytes. (default: %(default)s)",
+    )
+    addCopyOptions(parser_nbdstore)
+    parser_nbdsync = sub_parsers.add_parser(
+        "nbdsync", help="Apply extents marked dirty to existing images in place"
+    )
+    parser_nbdsync.add_argument(
+        "--target",
+        default="sync-{disk}.img",
+        type=str,
+        help="Target image to update, {disk} and {name} are replaced by "
+        "disk target and checkpoint name. (default: %(default)s)",
+    )
+    addCopyOptions(parser_nbdsync, incremental=False)
+    parser_verify = sub_parsers.add_parser(
+        "verify", help="Verify backup images against NBD export"
+    )
+    parser_verify.add_argument(
+        "--image",
+        default="backup-{disk}.{name}.qcow2",
+        type=str,
+        help="Backup image to verify, {disk} and {name} are replaced by "
+        "disk target and checkpoint name. (default: %(default)s)",
+    )
+    parser_verify.add_argument(
+        "--base",
+        default=None,
+        type=str,
+        help="Verified image of the parent checkpoint: only chunks marked "
+        "dirty are hashed, digests of other chunks are reused.",
+    )
+    parser_verify.add_argument(
+        "--chunk-size",
+        default=chunkstore.CHUNK_SIZE,
+        type=int,
+        help="Chunk size in bytes. (default: %(default)s)",
+    )
+    addConnectionOptions(parser_verify)
+    parser_restore = sub_parsers.add_parser(
+        "restore", help="Restore image from chunk store manifest or stream file"
+    )
+    parser_restore.add_argument(
+        "--source",
+        type=str,
+        help="Manifest or stream file to restore from, incremental stream files "
+        "are passed comma separated after the full backup they are based on.",
+        required=True,
+    )
+    parser_restore.add_argument(
+        "--target", type=str, help="Target image file", required=True
+    )
+    parser_restore.add_argument(
+        "--format",
+        default="raw",
+        choices=["qcow2", "raw"],
+        type=str,
+        help="Target image format. (default: %(default)s)",
+    )
+    parser_restore.add_argument(
+        "--store",
+        default=None,
+        type=str,
+        help="Path to chunk store, detected from manifest path if not set.",
+    )
+    nbdmap = sub_parsers.add_parser(
+        "nbdmap", help="Show NDB export mapping information"
+    )
+    nbdmap.add_argument(
+        "--base",
+        help="Show base:allocation mapping instead of bitmap.",
+        action="store_true",
+        required=False,
+    )
+    nbdmap.add_argument(
+        "--summary",
+        help="Show only amount of dirty data, extent count and largest runs.",
+        action="store_true",
+        required=False,
+    )
+    nbdmap.add_argument(
+        "--top",
+        default=5,
+        type=int,
+        help="Number of largest runs shown in summary. (default: %(default)s)",
+    )
+    sub_parsers.add_parser(
+        "overlay", help="Create qcow overlay images with NBD server backing"
+    )
+    sub_parsers.add_parser("status", help="Show export status and scratch usage")
+    sub_parsers.add_parser("release", help="Stop exporting blockjob")
+    parser_serve = sub_parsers.add_parser(
+        "serve", help="Handle requests via local socket"
+    )
+    parser_serve.add_argument(
+        "--listen",
+        default="/var/tmp/vircpt.sock",
+        type=str,
+        help="Path to unix socket for requests. (default: %(default)s)",
+    )
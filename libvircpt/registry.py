@@ -0,0 +1,199 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import re
+import json
+import stat
+import fcntl
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Iterator, List, Optional
+from libvircpt.exceptions import StateFileError
+
+log = logging.getLogger("registry")
+
+# name of scratch files as created by checkpoint.exportXml
+SCRATCH_NAME = re.compile(r"backup\.[A-Z0-9]{5}\.[\w-]+")
+
+
+def isScratch(scratchFile: str, scratchDirs: List[str]) -> bool:
+    """Check if file is named like a scratch file and located within
+    one of the scratch directories"""
+    directory, name = os.path.split(scratchFile)
+    return SCRATCH_NAME.fullmatch(name) is not None and os.path.realpath(directory) in {
+        os.path.realpath(d) for d in scratchDirs
+    }
+
+
+def removeScratch(scratchFiles: List[str], scratchDirs: List[str]) -> None:
+    """Remove left over scratch files, other files are never removed"""
+    for scratchFile in scratchFiles:
+        if not isScratch(scratchFile, scratchDirs):
+            log.warning("Not removing [%s]: not a scratch file.", scratchFile)
+            continue
+        try:
+            os.unlink(scratchFile)
+            log.debug("Removed left over scratch file: [%s]", scratchFile)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("Unable to remove scratch file: [%s]", e)
+
+
+@dataclass
+class exportEntry:
+    """Information about an active checkpoint export"""
+
+    domain: str
+    checkpoint: str
+    socket: str
+    started: float
+    disks: List[str] = field(default_factory=list)
+    scratch: List[str] = field(default_factory=list)
+    base: str = ""
+
+
+class registry:
+    """Keep track of active exports in a state file indexed by
+    domain name, access is serialized via file lock so multiple
+    processes can use the registry at the same time.
+
+    The state directory is created with mode 0700, the directory and
+    files within must be owned by the current user: otherwise other
+    users could add entries whose scratch files are removed on release.
+    Scratch files are only removed from the passed scratch directories."""
+
+    def __init__(self, stateDir: str, scratchDirs: Optional[List[str]] = None) -> None:
+        self.stateDir = stateDir
+        self.scratchDirs = scratchDirs or []
+        self.file = os.path.join(stateDir, "vircpt.exports.json")
+        self._lockFile = f"{self.file}.lock"
+
+    def _checkDir(self) -> None:
+        try:
+            os.makedirs(self.stateDir, mode=0o700, exist_ok=True)
+            st = os.lstat(self.stateDir)
+        except OSError as e:
+            raise StateFileError(f"Unable to create state directory: [{e}]") from e
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            raise StateFileError(
+                f"State directory [{self.stateDir}] is not owned by current user."
+            )
+        if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise StateFileError(
+                f"State directory [{self.stateDir}] is writable by other users."
+            )
+
+    @staticmethod
+    def _open(path: str, flags: int) -> int:
+        """Open file without following symlinks, refuse files owned by
+        other users"""
+        fd = os.open(path, flags | os.O_NOFOLLOW, 0o600)
+        if os.fstat(fd).st_uid != os.getuid():
+            os.close(fd)
+            raise StateFileError(f"File [{path}] is not owned by current user.")
+        return fd
+
+    @contextmanager
+    def _locked(self) -> Iterator[Dict[str, Dict]]:
+        """Lock state file and yield its content, changes are written
+        back atomically"""
+        self._checkDir()
+        try:
+            fd = self._open(self._lockFile, os.O_RDWR | os.O_CREAT)
+        except OSError as e:
+            raise StateFileError(f"Unable to open lock file: [{e}]") from e
+        with os.fdopen(fd, "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                before = dict(state)
+                yield state
+                if state != before:
+                    self._write(state)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self) -> Dict[str, Dict]:
+        try:
+            with os.fdopen(self._open(self.file, os.O_RDONLY), encoding="utf-8") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            raise StateFileError(f"Unable to read state file: [{e}]") from e
+        except ValueError as e:
+            log.warning("Ignoring invalid state file [%s]: [%s]", self.file, e)
+            return {}
+
+    def _write(self, state: Dict[str, Dict]) -> None:
+        tmpFile = f"{self.file}.tmp"
+        fd = self._open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(state, fh, indent=2)
+        os.replace(tmpFile, self.file)
+
+    def add(self, entry: exportEntry) -> None:
+        """Record export, replacing existing entry for domain"""
+        with self._locked() as state:
+            state[entry.domain] = asdict(entry)
+
+    def get(self, domain: str) -> Optional[exportEntry]:
+        """Return export for domain"""
+        with self._locked() as state:
+            entry = state.get(domain)
+        if entry is None:
+            return None
+        return exportEntry(**entry)
+
+    def remove(self, domain: str) -> Optional[exportEntry]:
+        """Remove export for domain"""
+        with self._locked() as state:
+            entry = state.pop(domain, None)
+        if entry is None:
+            return None
+        return exportEntry(**entry)
+
+    def lookup(self, domain: str) -> Optional[exportEntry]:
+        """Return export for domain if its socket still exists,
+        stale entries left by crashed processes or exports which have
+        been stopped otherwise are removed. For TCP exports the URI is
+        recorded instead of the socket, they are kept until released."""
+        entry = self.get(domain)
+        if entry is None or "://" in entry.socket or os.path.exists(entry.socket):
+            return entry
+
+        log.warning(
+            "Removing stale export of checkpoint [%s]: socket [%s] does not exist.",
+            entry.checkpoint,
+            entry.socket,
+        )
+        self.release(domain)
+        return None
+
+    def release(self, domain: str) -> None:
+        """Remove export and left over scratch files"""
+        entry = self.remove(domain)
+        if entry is None:
+            return
+        removeScratch(entry.scratch, self.scratchDirs)
+
+    def entries(self) -> List[exportEntry]:
+        """Return all recorded exports"""
+        with self._locked() as state:
+            return [exportEntry(**entry) for entry in state.values()]
@@ -0,0 +1,124 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import logging
+from itertools import cycle
+from subprocess import CalledProcessError
+from typing import Any, Dict, List
+import libvirt
+from libvircpt import command
+from libvircpt.exceptions import ScratchSpaceError
+
+log = logging.getLogger("scratch")
+
+
+def freeSpace(directory: str) -> int:
+    """Return space available to unprivileged users in bytes"""
+    st = os.statvfs(directory)
+    return st.f_bavail * st.f_frsize
+
+
+def usage(scratchFile: str) -> int:
+    """Return allocated size of scratch file in bytes"""
+    try:
+        return os.stat(scratchFile).st_blocks * 512
+    except OSError:
+        return 0
+
+
+class placement:
+    """Distribute scratch files of an export across multiple
+    directories, either round robin or to the directory having the
+    most free space left. The disk size is accounted as worst case
+    scratch usage for each placed disk. If reserve is set, disks are
+    only placed to directories which can hold the worst case usage."""
+
+    def __init__(self, directories: List[str], balance: str, reserve: bool) -> None:
+        self.balance = balance
+        self.reserve = reserve
+        self.free: Dict[str, int] = {}
+        for directory in directories:
+            try:
+                self.free[directory] = freeSpace(directory)
+            except OSError as e:
+                log.warning("Skipping scratch directory [%s]: [%s]", directory, e)
+        if not self.free:
+            raise ScratchSpaceError("No usable scratch directory found.")
+        self._next = cycle(list(self.free))
+
+    def _candidates(self, size: int) -> List[str]:
+        if not self.reserve:
+            return list(self.free)
+        return [d for d, free in self.free.items() if free >= size]
+
+    def choose(self, size: int) -> str:
+        """Return directory for scratch file of disk with size"""
+        candidates = self._candidates(size)
+        if not candidates:
+            raise ScratchSpaceError(
+                f"No scratch directory with [{size}] bytes free space left."
+            )
+
+        if self.balance == "roundrobin":
+            directory = next(self._next)
+            while directory not in candidates:
+                directory = next(self._next)
+        else:
+            directory = max(candidates, key=lambda d: self.free[d])
+
+        self.free[directory] -= size
+        log.debug(
+            "Scratch directory [%s]: [%s] bytes left after placement",
+            directory,
+            self.free[directory],
+        )
+        return directory
+
+
+def create(scratchFile: str, size: int) -> None:
+    """Create scratch file as qcow2 image with space for the complete
+    disk allocated, libvirt reuses it for the export"""
+    log.debug("Preallocating scratch file [%s]: [%s] bytes", scratchFile, size)
+    try:
+        command.run(
+            [
+                "qemu-img",
+                "create",
+                "-q",
+                "-f",
+                "qcow2",
+                "-o",
+                "preallocation=falloc",
+                scratchFile,
+                f"{size}B",
+            ]
+        )
+    except (CalledProcessError, FileNotFoundError) as e:
+        raise ScratchSpaceError(
+            f"Unable to create scratch file [{scratchFile}]: "
+            f"[{getattr(e, 'stderr', e)}]"
+        ) from e
+
+
+def jobUsage(domObj: libvirt.virDomain) -> Dict[str, Any]:
+    """Return scratch usage of active backup job as reported by
+    libvirt job statistics"""
+    stats = domObj.jobStats()
+    return {
+        "used": stats.get(libvirt.VIR_DOMAIN_JOB_DISK_TEMP_USED),
+        "total": stats.get(libvirt.VIR_DOMAIN_JOB_DISK_TEMP_TOTAL),
+    }
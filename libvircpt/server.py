@@ -0,0 +1,146 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import logging
+import threading
+import socketserver
+from typing import Any, Callable, Dict, Optional
+import libvirt
+
+log = logging.getLogger("server")
+
+blockJobStatus = {
+    libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED: "completed",
+    libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED: "failed",
+    libvirt.VIR_DOMAIN_BLOCK_JOB_CANCELED: "canceled",
+    libvirt.VIR_DOMAIN_BLOCK_JOB_READY: "ready",
+}
+
+
+def startEventLoop() -> threading.Thread:
+    """Register libvirt default event loop implementation and run
+    it in background thread. Must be called before the libvirt
+    connection is opened."""
+    libvirt.virEventRegisterDefaultImpl()
+
+    def _run() -> None:
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    thread = threading.Thread(target=_run, name="libvirt-event-loop", daemon=True)
+    thread.start()
+    return thread
+
+
+class eventHandler:
+    """Keep track of block job and job completed events per domain,
+    so requests can wait for job completion without polling"""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+
+    def _update(self, domain: str, event: Dict[str, Any]) -> None:
+        with self._cond:
+            self.jobs[domain] = event
+            self._cond.notify_all()
+
+    def blockJob(
+        self, _conn, domObj, disk: str, jobType: int, status: int, _opaque
+    ) -> None:
+        """Callback for VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2"""
+        state = blockJobStatus.get(status, str(status))
+        log.info(
+            "Domain: [%s]: block job type [%s] for disk [%s]: [%s]",
+            domObj.name(),
+            jobType,
+            disk,
+            state,
+        )
+        if jobType == libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_BACKUP:
+            self._update(domObj.name(), {"event": "blockjob", "status": state})
+
+    def jobCompleted(self, _conn, domObj, params: Dict[str, Any], _opaque) -> None:
+        """Callback for VIR_DOMAIN_EVENT_ID_JOB_COMPLETED"""
+        log.info("Domain: [%s]: job completed", domObj.name())
+        log.debug(params)
+        self._update(
+            domObj.name(),
+            {"event": "completed", "status": "completed", "stats": params},
+        )
+
+    def get(self, domain: str) -> Optional[Dict[str, Any]]:
+        """Return last received event for domain"""
+        with self._cond:
+            return self.jobs.get(domain)
+
+    def clear(self, domain: str) -> None:
+        """Forget last event for domain, called before a new job starts"""
+        with self._cond:
+            self.jobs.pop(domain, None)
+
+    def wait(self, domain: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait until event for domain is received"""
+        with self._cond:
+            self._cond.wait_for(lambda: domain in self.jobs, timeout)
+            return self.jobs.get(domain)
+
+
+class _requestHandler(socketserver.StreamRequestHandler):
+    """Read requests as JSON lines and write responses as JSON lines"""
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be an object")
+            except ValueError as e:
+                response = {"status": "error", "message": f"Invalid request: {e}"}
+            else:
+                log.debug("Request: %s", request)
+                try:
+                    response = self.server.dispatch(request)  # type: ignore
+                except Exception as e:  # pylint: disable=broad-except
+                    log.exception("Unable to handle request: [%s]", e)
+                    response = {"status": "error", "message": str(e)}
+            self.wfile.write(f"{json.dumps(response)}\n".encode())
+            self.wfile.flush()
+
+
+class server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Local unix socket server, each client connection is handled
+    in its own thread"""
+
+    daemon_threads = True
+
+    def __init__(
+        self, socketFile: str, dispatch: Callable[[Dict[str, Any]], Dict[str, Any]]
+    ) -> None:
+        if os.path.exists(socketFile):
+            os.unlink(socketFile)
+        self.dispatch = dispatch
+        super().__init__(socketFile, _requestHandler)
+        os.chmod(socketFile, 0o600)
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            os.unlink(self.server_address)  # type: ignore
+        except OSError:
+            pass
@@ -0,0 +1,97 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+import threading
+from typing import List, Tuple
+import libvirt
+from libvircpt.transfer import rateLimiter
+
+log = logging.getLogger("throttle")
+
+# seconds between block statistics samples
+INTERVAL = 2.0
+
+
+class adaptiveThrottle(threading.Thread):
+    """Sample guest block statistics and adjust the copy rate:
+    the rate is halved if the average guest I/O latency exceeds the
+    limit or guest IOPS rise above the observed baseline, otherwise
+    it is increased step by step up to the rate initially set for the
+    limiter"""
+
+    def __init__(
+        self,
+        domObj: libvirt.virDomain,
+        disks: List[str],
+        limiter: rateLimiter,
+        maxLatency: float,
+    ) -> None:
+        super().__init__(name="adaptive-throttle", daemon=True)
+        self.domObj = domObj
+        self.disks = disks
+        self.limiter = limiter
+        self.maxRate = limiter.rate
+        self.maxLatency = maxLatency
+        self.baseline = 0.0
+        self._stopEvent = threading.Event()
+
+    def sample(self) -> Tuple[int, int]:
+        """Return sum of guest I/O operations and time spent in ns"""
+        operations = 0
+        spent = 0
+        for disk in self.disks:
+            stats = self.domObj.blockStatsFlags(disk)
+            operations += stats.get("rd_operations", 0) + stats.get("wr_operations", 0)
+            spent += stats.get("rd_total_times", 0) + stats.get("wr_total_times", 0)
+        return operations, spent
+
+    def adjust(self, iops: float, latency: float) -> float:
+        """Return new rate for measured guest IOPS and latency in ms"""
+        rate = self.limiter.rate
+        if latency > self.maxLatency or (self.baseline and iops > 2 * self.baseline):
+            return max(self.maxRate / 64, rate / 2)
+
+        # baseline is only updated while the guest is not under pressure
+        self.baseline = iops if not self.baseline else 0.8 * self.baseline + 0.2 * iops
+        return min(self.maxRate, rate + self.maxRate / 16)
+
+    def run(self) -> None:
+        try:
+            operations, spent = self.sample()
+            while not self._stopEvent.wait(INTERVAL):
+                newOperations, newSpent = self.sample()
+                ops = newOperations - operations
+                latency = (newSpent - spent) / ops / 1000000 if ops > 0 else 0.0
+                operations, spent = newOperations, newSpent
+                rate = self.adjust(ops / INTERVAL, latency)
+                if rate != self.limiter.rate:
+                    log.debug(
+                        "Guest IOPS: [%.0f] latency: [%.2f]ms: copy rate: [%.2f] MiB/s",
+                        ops / INTERVAL,
+                        latency,
+                        rate / 1024 / 1024,
+                    )
+                    self.limiter.setRate(rate)
+        except libvirt.libvirtError as e:
+            log.warning(
+                "Unable to sample block statistics, throttling stopped: [%s]", e
+            )
+
+    def stop(self) -> None:
+        """Stop sampling"""
+        self._stopEvent.set()
+        self.join()
@@ -0,0 +1,455 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from functools import lru_cache
+from dataclasses import dataclass, field
+from subprocess import CalledProcessError
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+import nbd
+from libvircpt import nbdcli
+from libvircpt import command
+from libvircpt import chunkstream
+from libvircpt.exceptions import (
+    DiskBackupFailed,
+    DiskBackupWriterException,
+    NbdException,
+)
+
+log = logging.getLogger("transfer")
+
+# maximum request size accepted by the qemu NBD server is 32 MiB
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# maximum length of a single zero request
+ZERO_SIZE = 2**30
+
+
+class rateLimiter:
+    """Token bucket limiting the copy throughput, shared by all copy
+    threads. A rate of 0 disables limiting, the rate can be adjusted
+    while the copy is running."""
+
+    def __init__(self, rate: float = 0) -> None:
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def setRate(self, rate: float) -> None:
+        """Change rate in bytes per second"""
+        with self._lock:
+            self.rate = rate
+            self._tokens = min(self._tokens, rate)
+
+    def reserve(self, length: int) -> float:
+        """Account length bytes and return the time in seconds the
+        caller has to wait before the data may be transferred"""
+        with self._lock:
+            if self.rate <= 0:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= length
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def consume(self, length: int) -> None:
+        """Account length bytes and sleep if the rate is exceeded"""
+        wait = self.reserve(length)
+        if wait > 0:
+            time.sleep(wait)
+
+
+@dataclass
+class copyOptions:
+    """Options for copy operation"""
+
+    connections: int = 4
+    requests: int = 8
+    limiter: Optional[rateLimiter] = None
+    chunkSize: int = CHUNK_SIZE
+    progress: Optional[Callable[[int, int], None]] = None
+    # target reads as zero where nothing is written
+    sparse: bool = False
+    detectZeroes: bool = False
+
+
+@dataclass
+class copyStats:
+    """Statistics about a single disk copy"""
+
+    target: str
+    bytes: int = 0
+    skipped: int = 0
+    elapsed: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, length: int) -> None:
+        """Account copied bytes, called from multiple threads"""
+        with self._lock:
+            self.bytes += length
+
+    def skip(self, length: int) -> None:
+        """Account zero bytes not transferred"""
+        with self._lock:
+            self.skipped += length
+
+    @property
+    def throughput(self) -> float:
+        """Copy rate in MiB/s"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.bytes / self.elapsed / 1024 / 1024
+
+
+class fileWriter:
+    """Write raw image files directly using positional writes,
+    safe to be used by multiple threads"""
+
+    def __init__(self, fileName: str, size: int, truncate: bool = True) -> None:
+        self.fileName = fileName
+        self.sparse = truncate
+        flags = os.O_WRONLY | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        try:
+            self._fd = os.open(fileName, flags, 0o644)
+            os.ftruncate(self._fd, size)
+        except OSError as e:
+            raise DiskBackupWriterException(
+                f"Unable to open target file [{fileName}]: [{e}]"
+            ) from e
+
+    def write(self, offset: int, data: Union[bytes, bytearray]) -> None:
+        """Write data at offset"""
+        os.pwrite(self._fd, data, offset)
+
+    def zero(self, offset: int, length: int) -> None:
+        """Zero range, nothing to do for newly created files"""
+        if self.sparse:
+            return
+        for start, size in chunks([(offset, length)]):
+            os.pwrite(self._fd, _zeroes(size), start)
+
+    def close(self) -> None:
+        """Flush and close target file"""
+        os.fsync(self._fd)
+        os.close(self._fd)
+
+
+class nbdWriter:
+    """Write qcow images via qemu-nbd. Each copy thread uses its own
+    connection, so the writes of all threads are in flight at the same
+    time instead of being serialized by a shared libnbd handle."""
+
+    def __init__(
+        self, fileName: str, imageFormat: str = "qcow2", sparse: bool = False
+    ) -> None:
+        self.fileName = fileName
+        self.sparse = sparse
+        self._handles: List[nbd.NBD] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        try:
+            self._tmpDir, self._uri = nbdcli.startServer(
+                fileName, imageFormat, 0, ["--discard=unmap"]
+            )
+        except NbdException as e:
+            raise DiskBackupWriterException(e) from e
+
+    def _handle(self) -> nbd.NBD:
+        handle = getattr(self._local, "handle", None)
+        if handle is None:
+            handle = nbdcli.connect(self._uri)
+            with self._lock:
+                self._handles.append(handle)
+            self._local.handle = handle
+        return handle
+
+    def write(self, offset: int, data: Union[bytes, bytearray]) -> None:
+        """Write data at offset"""
+        self._handle().pwrite(data, offset)
+
+    def zero(self, offset: int, length: int) -> None:
+        """Zero range, qemu-nbd writes zero clusters or unmaps them.
+        Nothing to do for newly created images without backing file."""
+        if self.sparse:
+            return
+        handle = self._handle()
+        for start, size in chunks([(offset, length)], ZERO_SIZE):
+            handle.zero(size, start)
+
+    def close(self) -> None:
+        """Flush and close all connections, stop qemu-nbd"""
+        try:
+            for handle in self._handles:
+                handle.flush()
+        finally:
+            for handle in self._handles:
+                nbdcli.disconnect(handle)
+            nbdcli.stopServer(self._tmpDir, self.fileName)
+
+
+def createCommand(
+    fileName: str,
+    size: int,
+    imageFormat: str = "qcow2",
+    backingFile: Optional[str] = None,
+) -> List[str]:
+    """Return qemu-img command line creating the target image"""
+    cmd = ["qemu-img", "create", "-q", "-f", imageFormat]
+    if backingFile is not None:
+        cmd += ["-F", "qcow2", "-b", backingFile]
+    return cmd + [fileName, f"{size}B"]
+
+
+def createImage(
+    fileName: str,
+    size: int,
+    imageFormat: str = "qcow2",
+    backingFile: Optional[str] = None,
+) -> None:
+    """Create target image via qemu-img, if backing file is set the
+    image is created as overlay to the existing image"""
+    try:
+        command.run(createCommand(fileName, size, imageFormat, backingFile))
+    except (CalledProcessError, FileNotFoundError) as e:
+        stderr = getattr(e, "stderr", e)
+        raise DiskBackupWriterException(
+            f"Unable to create target image [{fileName}]: [{stderr}]"
+        ) from e
+
+
+def openWriter(  # pylint: disable=too-many-arguments
+    fileName: str,
+    size: int,
+    imageFormat: str = "qcow2",
+    backingFile: Optional[str] = None,
+    level: int = 3,
+    streamInfo: Optional[Dict[str, Any]] = None,
+) -> Union[fileWriter, nbdWriter, chunkstream.streamWriter]:
+    """Create target image and return matching writer, streamInfo is
+    recorded in the index of stream files"""
+    if imageFormat == "raw":
+        return fileWriter(fileName, size)
+    if imageFormat == "stream":
+        return chunkstream.streamWriter(fileName, size, level, streamInfo)
+
+    createImage(fileName, size, imageFormat, backingFile)
+    return nbdWriter(fileName, imageFormat, backingFile is None)
+
+
+def imageSize(fileName: str) -> int:
+    """Return virtual size of existing image"""
+    try:
+        info = json.loads(
+            command.run(["qemu-img", "info", "--output=json", fileName]).stdout
+        )
+        return info["virtual-size"]
+    except (CalledProcessError, FileNotFoundError, ValueError, KeyError) as e:
+        raise DiskBackupWriterException(
+            f"Unable to get size of image [{fileName}]: [{e}]"
+        ) from e
+
+
+def openTarget(
+    fileName: str, size: int, imageFormat: str = "qcow2"
+) -> Union[fileWriter, nbdWriter]:
+    """Open existing image for updating it in place, the image is
+    extended or truncated if its size does not match"""
+    if imageFormat == "raw":
+        return fileWriter(fileName, size, truncate=False)
+
+    current = imageSize(fileName)
+    if current != size:
+        log.info("Resizing image [%s] from [%s] to [%s] bytes", fileName, current, size)
+        try:
+            command.run(
+                ["qemu-img", "resize", "-q", "--shrink", "-f", imageFormat]
+                + [fileName, f"{size}"]
+            )
+        except (CalledProcessError, FileNotFoundError) as e:
+            stderr = getattr(e, "stderr", e)
+            raise DiskBackupWriterException(
+                f"Unable to resize image [{fileName}]: [{stderr}]"
+            ) from e
+    return nbdWriter(fileName, imageFormat)
+
+
+def chunks(
+    ranges: List[Tuple[int, int]], chunkSize: int = CHUNK_SIZE
+) -> Iterator[Tuple[int, int]]:
+    """Split ranges into requests not exceeding chunkSize"""
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            size = min(chunkSize, end - offset)
+            yield offset, size
+            offset += size
+
+
+@lru_cache(maxsize=4)
+def _zeroes(length: int) -> bytes:
+    return bytes(length)
+
+
+def isZero(data: Union[bytes, bytearray]) -> bool:
+    """Check if data consists of zero bytes only"""
+    return data == _zeroes(len(data))
+
+
+class _workQueue:
+    """Hand out chunks to the copy threads"""
+
+    def __init__(self, items: Iterator[Tuple[int, int]]) -> None:
+        self._items = items
+        self._lock = threading.Lock()
+        self.abort = threading.Event()
+
+    def get(self) -> Optional[Tuple[int, int]]:
+        """Return next chunk or None if work is done"""
+        if self.abort.is_set():
+            return None
+        with self._lock:
+            return next(self._items, None)
+
+
+def deliver(
+    writer: Any,
+    offset: int,
+    data: Union[bytes, bytearray],
+    opt: copyOptions,
+    stats: copyStats,
+) -> None:
+    """Pass chunk read from the export to the writer, blocks consisting
+    of zeroes are zeroed in the target or skipped if it is sparse"""
+    if opt.detectZeroes and isZero(data):
+        if not opt.sparse:
+            writer.zero(offset, len(data))
+        stats.skip(len(data))
+    else:
+        writer.write(offset, data)
+        stats.add(len(data))
+    if opt.progress is not None:
+        opt.progress(offset, len(data))
+
+
+def zero(
+    target: str,
+    writer: Any,
+    ranges: List[Tuple[int, int]],
+    opt: copyOptions,
+    stats: copyStats,
+) -> None:
+    """Zero ranges reported as zero in the target without reading
+    them, nothing is written if the target is sparse"""
+    try:
+        for offset, length in ranges:
+            if not opt.sparse:
+                writer.zero(offset, length)
+                if opt.progress is not None:
+                    opt.progress(offset, length)
+            stats.skip(length)
+    except (nbd.Error, OSError) as e:
+        raise DiskBackupFailed(f"Zeroing disk [{target}] failed: [{e}]") from e
+
+
+def _worker(
+    nbdUri: str,
+    writer: Any,
+    work: _workQueue,
+    opt: copyOptions,
+    stats: copyStats,
+) -> None:
+    """Read chunks from the NBD export with multiple requests in
+    flight and pass data to the writer in order of submission"""
+    handle = nbdcli.connect(nbdUri)
+    inflight: deque = deque()
+    try:
+        while True:
+            while len(inflight) < opt.requests:
+                item = work.get()
+                if item is None:
+                    break
+                offset, length = item
+                if opt.limiter is not None:
+                    opt.limiter.consume(length)
+                buf = nbd.Buffer(length)
+                cookie = handle.aio_pread(buf, offset)
+                inflight.append((cookie, buf, offset, length))
+
+            if not inflight:
+                break
+
+            cookie, buf, offset, length = inflight.popleft()
+            while not handle.aio_command_completed(cookie):
+                handle.poll(-1)
+            deliver(writer, offset, buf.to_bytearray(), opt, stats)
+    finally:
+        nbdcli.disconnect(handle)
+
+
+def copy(  # pylint: disable=too-many-arguments
+    target: str,
+    nbdUri: str,
+    writer: Any,
+    ranges: List[Tuple[int, int]],
+    opt: copyOptions,
+    zeroRanges: Optional[List[Tuple[int, int]]] = None,
+) -> copyStats:
+    """Copy ranges from NBD export to writer using multiple
+    connections, each having multiple requests in flight. Zero
+    ranges are not read: they are zeroed in the target or skipped
+    if the target is sparse."""
+    stats = copyStats(target)
+    work = _workQueue(chunks(ranges, opt.chunkSize))
+    errors: List[Exception] = []
+
+    def _run() -> None:
+        try:
+            _worker(nbdUri, writer, work, opt, stats)
+        except Exception as e:  # pylint: disable=broad-except
+            # any writer error must fail the copy
+            work.abort.set()
+            errors.append(e)
+
+    log.debug(
+        "Copy [%s] using [%s] connections with [%s] requests in flight.",
+        nbdUri,
+        opt.connections,
+        opt.requests,
+    )
+    start = time.monotonic()
+    zero(target, writer, zeroRanges or [], opt, stats)
+    threads = [
+        threading.Thread(target=_run, daemon=True) for _ in range(opt.connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.elapsed = time.monotonic() - start
+
+    if errors:
+        raise DiskBackupFailed(f"Copy of disk [{target}] failed: [{errors[0]}]")
+
+    return stats
@@ -0,0 +1,188 @@
+"""
+    Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+import nbd
+from libvircpt import nbdcli
+from libvircpt import extents
+from libvircpt import transfer
+from libvircpt.backup import dirtyRanges
+from libvircpt.client import diskSize
+from libvircpt.exceptions import BackupException, NbdException
+
+log = logging.getLogger("verify")
+
+# digest recorded for chunks which are unallocated or contain zeros only
+ZERO = "0" * 64
+
+
+class digestWriter:
+    """Writer interface for the copy engine which computes the sha256
+    digest of each chunk instead of storing data"""
+
+    def __init__(self) -> None:
+        self.digests: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def write(self, offset: int, data: Union[bytes, bytearray]) -> None:
+        """Compute digest for chunk at offset"""
+        digest = ZERO
+        if data.count(0) != len(data):
+            digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self.digests[offset] = digest
+
+    def close(self) -> None:
+        """Nothing to close"""
+
+
+def treeHash(digests: Dict[int, str], size: int, chunkSize: int) -> str:
+    """Compute root hash over the digests of all chunks in order,
+    chunks without digest are treated as zero chunks"""
+    root = hashlib.sha256()
+    for offset in range(0, size, chunkSize):
+        root.update(bytes.fromhex(digests.get(offset, ZERO)))
+    return root.hexdigest()
+
+
+def dataRanges(nbdUri: str, size: int, chunkSize: int) -> List[Tuple[int, int]]:
+    """Return chunk aligned ranges which contain data as reported by
+    base:allocation, zero and unallocated extents are skipped"""
+    handle = nbdcli.connect(nbdUri, [extents.BASE_ALLOCATION])
+    try:
+        data = extents.ranges(
+            extents.query(handle, extents.BASE_ALLOCATION),
+            extents.STATE_ZERO,
+            False,
+        )
+        return extents.align(list(data), chunkSize, size)
+    finally:
+        nbdcli.disconnect(handle)
+
+
+def hashRanges(
+    target: str,
+    nbdUri: str,
+    ranges: List[Tuple[int, int]],
+    opt: transfer.copyOptions,
+    base: Optional[Dict[int, str]] = None,
+) -> Dict[int, str]:
+    """Hash ranges of NBD export using multiple connections, for
+    incremental verification the digests of the other chunks are
+    taken from base"""
+    writer = digestWriter()
+    transfer.copy(target, nbdUri, writer, ranges, opt)
+    digests = dict(base or {})
+    for offset, value in writer.digests.items():
+        if value == ZERO:
+            digests.pop(offset, None)
+        else:
+            digests[offset] = value
+    return digests
+
+
+def loadDigests(fileName: str, chunkSize: int) -> Dict[int, str]:
+    """Load per chunk digests stored during last verification"""
+    try:
+        with open(fileName, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+    except (OSError, ValueError) as e:
+        raise BackupException(f"Unable to read digests [{fileName}]: [{e}]") from e
+    if data["chunkSize"] != chunkSize:
+        raise BackupException(
+            f"Chunk size of digests [{fileName}] does not match [{chunkSize}]"
+        )
+    return {int(offset): value for offset, value in data["digests"].items()}
+
+
+def saveDigests(fileName: str, size: int, chunkSize: int, digests, root) -> None:
+    """Store per chunk digests for later incremental verification"""
+    with open(f"{fileName}.tmp", "w", encoding="utf-8") as fh:
+        json.dump(
+            {
+                "size": size,
+                "chunkSize": chunkSize,
+                "root": root,
+                "digests": {str(k): v for k, v in sorted(digests.items())},
+            },
+            fh,
+        )
+    os.replace(f"{fileName}.tmp", fileName)
+
+
+def _imageFormat(fileName: str) -> str:
+    return "qcow2" if fileName.endswith(".qcow2") else "raw"
+
+
+def verifyDisk(args, domObj, disk: Any) -> None:
+    """Compare tree hash of exported disk with tree hash of backup image"""
+    size = diskSize(domObj, disk)
+    image = args.image.format(disk=disk.target, name=args.name)
+    exportUri = nbdcli.uri(args.socketfile, disk.target)
+    opt = transfer.copyOptions(args.connections, args.requests, None, args.chunk_size)
+    base = None
+    try:
+        if args.base is not None:
+            baseImage = args.base.format(disk=disk.target, name=args.name)
+            base = loadDigests(f"{baseImage}.digests", args.chunk_size)
+            exportRanges = extents.align(
+                dirtyRanges(exportUri, args.name), args.chunk_size, size
+            )
+        else:
+            exportRanges = dataRanges(exportUri, size, args.chunk_size)
+        exportDigests = hashRanges(disk.target, exportUri, exportRanges, opt, base)
+
+        with nbdcli.serveImage(image, _imageFormat(image), args.connections) as uri:
+            imageRanges = exportRanges
+            if base is None:
+                imageRanges = dataRanges(uri, size, args.chunk_size)
+            imageDigests = hashRanges(disk.target, uri, imageRanges, opt, base)
+    except (BackupException, NbdException, nbd.Error) as e:
+        log.error("Failed to verify disk [%s]: [%s]", disk.target, e)
+        return
+
+    exportRoot = treeHash(exportDigests, size, args.chunk_size)
+    imageRoot = treeHash(imageDigests, size, args.chunk_size)
+    if exportRoot != imageRoot:
+        mismatch = sorted(
+            offset
+            for offset in set(exportDigests) | set(imageDigests)
+            if exportDigests.get(offset, ZERO) != imageDigests.get(offset, ZERO)
+        )
+        log.error(
+            "Disk: [%s]: image [%s] does not match export: [%s] chunks differ, "
+            "first at offset [%s]",
+            disk.target,
+            image,
+            len(mismatch),
+            mismatch[0] if mismatch else None,
+        )
+        return
+
+    saveDigests(f"{image}.digests", size, args.chunk_size, imageDigests, imageRoot)
+    log.info(
+        "Disk: [%s]: image [%s] matches export, hashed [%s] of [%s] chunks: [%s]",
+        disk.target,
+        image,
+        sum(-(-length // args.chunk_size) for _, length in exportRanges),
+        -(-size // args.chunk_size),
+        imageRoot,
+    )